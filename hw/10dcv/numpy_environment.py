@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+
+import discretization
+
+class _CartPole:
+    # The dynamics of gym CartPole, computed on [count, 4] arrays of states
+    # (cart position, cart velocity, pole angle, pole angle velocity)
+    observations = 4
+    actions = 2
+
+    gravity = 9.8
+    masscart = 1.0
+    masspole = 0.1
+    total_mass = masspole + masscart
+    length = 0.5
+    polemass_length = masspole * length
+    force_mag = 10.0
+    tau = 0.02
+    theta_threshold_radians = 12 * 2 * np.pi / 360
+    x_threshold = 2.4
+
+    def reset(self, random, count):
+        return random.uniform(low=-0.05, high=0.05, size=[count, 4])
+
+    def step(self, states, actions):
+        x, x_dot, theta, theta_dot = states.T
+        force = np.where(actions == 1, self.force_mag, -self.force_mag)
+        costheta, sintheta = np.cos(theta), np.sin(theta)
+        temp = (force + self.polemass_length * theta_dot * theta_dot * sintheta) / self.total_mass
+        thetaacc = (self.gravity * sintheta - costheta * temp) / \
+                   (self.length * (4.0 / 3.0 - self.masspole * costheta * costheta / self.total_mass))
+        xacc = temp - self.polemass_length * thetaacc * costheta / self.total_mass
+        x, x_dot = x + self.tau * x_dot, x_dot + self.tau * xacc
+        theta, theta_dot = theta + self.tau * theta_dot, theta_dot + self.tau * thetaacc
+
+        dones = (x < -self.x_threshold) | (x > self.x_threshold) | \
+                (theta < -self.theta_threshold_radians) | (theta > self.theta_threshold_radians)
+        return np.stack([x, x_dot, theta, theta_dot], axis=1), np.ones(len(states)), dones
+
+class _MountainCar:
+    # The dynamics of gym MountainCar, computed on [count, 2] arrays of states (car position, car velocity)
+    observations = 2
+    actions = 3
+
+    min_position = -1.2
+    max_position = 0.6
+    max_speed = 0.07
+    goal_position = 0.5
+
+    def reset(self, random, count):
+        return np.stack([random.uniform(low=-0.6, high=-0.4, size=count), np.zeros(count)], axis=1)
+
+    def step(self, states, actions):
+        position, velocity = states.T
+        velocity = np.clip(velocity + (actions - 1) * 0.001 + np.cos(3 * position) * (-0.0025),
+                           -self.max_speed, self.max_speed)
+        position = np.clip(position + velocity, self.min_position, self.max_position)
+        velocity = np.where((position == self.min_position) & (velocity < 0), 0, velocity)
+
+        dones = position >= self.goal_position
+        return np.stack([position, velocity], axis=1), -np.ones(len(states)), dones
+
+# The supported environments, with their dynamics and the maximum episode lengths of gym
+_ENVIRONMENTS = {
+    "CartPole-v0": (_CartPole, 200),
+    "CartPole-v1": (_CartPole, 500),
+    "MountainCar-v0": (_MountainCar, 200),
+}
+
+class NumpyEnvironment:
+    """CartPole or MountainCar instances simulated together on NumPy arrays, without gym.
+
+    The environment has the interface of VectorEnvironment over EnvironmentContinuous
+    (or EnvironmentDiscrete if discrete=True), with observations, states, actions,
+    reset and step, including the automatic reset of the ended episodes, e.g.:
+
+        env = NumpyEnvironment("CartPole-v1", 4096)
+        observations = env.reset()
+        while ...:
+            observations, rewards, dones, infos = env.step(actions)
+
+    The dynamics follow gym step for step, see validate. The initial states are
+    sampled from the same distributions as in gym, using a RandomState with the
+    given seed.
+    """
+
+    def __init__(self, env_name, count, discrete=False, seed=None):
+        if env_name not in _ENVIRONMENTS:
+            raise ValueError("Environment {} has no NumPy implementation, only {} are supported".format(
+                env_name, ", ".join(sorted(_ENVIRONMENTS))))
+        dynamics, self._max_steps = _ENVIRONMENTS[env_name]
+        self._dynamics = dynamics()
+        self._env_name = env_name
+        self._count = count
+        self._random = np.random.RandomState(seed)
+
+        self._is_discrete = discrete
+        if self._is_discrete:
+            self._bins, self._separators, self._place_values = discretization.discretization(env_name)
+
+        self._states = self._dynamics.reset(self._random, count)
+        self._returns = np.zeros(count, np.float64)
+        self._lengths = np.zeros(count, np.int64)
+
+    def _observe(self, states):
+        if self._is_discrete:
+            return discretization.discretize(states, self._separators, self._place_values)
+        return np.array(states)
+
+    @property
+    def count(self):
+        return self._count
+
+    @property
+    def observations(self):
+        return self._dynamics.observations
+
+    @property
+    def states(self):
+        if not self._is_discrete:
+            raise ValueError("Only discrete NumpyEnvironment has states")
+        return self._bins ** len(self._separators)
+
+    @property
+    def actions(self):
+        return self._dynamics.actions
+
+    def reset(self):
+        """Reset all environments and return their stacked observations."""
+        self._states = self._dynamics.reset(self._random, self._count)
+        self._returns[:], self._lengths[:] = 0, 0
+        return self._observe(self._states)
+
+    def step(self, actions):
+        """Perform one action in every environment, see VectorEnvironment.step."""
+        states, rewards, dones = self._dynamics.step(self._states, np.asarray(actions))
+        self._returns += rewards
+        self._lengths += 1
+        dones |= self._lengths >= self._max_steps
+
+        observations = self._observe(states)
+        infos = [{} for _ in range(self._count)]
+        ended = np.where(dones)[0]
+        if len(ended):
+            for i in ended:
+                infos[i] = {"terminal_observation": np.array(observations[i]),
+                            "episode_return": self._returns[i], "episode_length": self._lengths[i]}
+            states[ended] = self._dynamics.reset(self._random, len(ended))
+            observations[ended] = self._observe(states[ended])
+            self._returns[ended], self._lengths[ended] = 0, 0
+        self._states = states
+
+        return observations, rewards.astype(np.float32), dones, infos
+
+    def render(self):
+        raise ValueError("NumpyEnvironment cannot be rendered, use EnvironmentContinuous instead")
+
+
+def validate(env_name, count=16, steps=1000, seed=42):
+    """Compare NumpyEnvironment with gym environments seeded by seed, seed + 1, ...
+
+    Before every step, the states of the gym environments are copied to the
+    NumpyEnvironment, and both perform the same random actions. Raises ValueError
+    if the rewards or the done flags differ, and returns the maximum absolute
+    difference of the observations (which can be nonzero only due to rounding).
+    """
+    import gym
+
+    envs = [gym.make(env_name) for _ in range(count)]
+    for i, env in enumerate(envs):
+        env.seed(seed + i)
+        env.reset()
+    numpy_env = NumpyEnvironment(env_name, count, seed=seed)
+    numpy_env.reset()
+    random = np.random.RandomState(seed)
+
+    max_difference = 0
+    for step in range(steps):
+        numpy_env._states = np.array([env.unwrapped.state for env in envs], np.float64)
+        actions = random.randint(numpy_env.actions, size=count)
+        observations, rewards, dones, infos = numpy_env.step(actions)
+        for i, (env, action) in enumerate(zip(envs, actions)):
+            observation, reward, done, _ = env.step(int(action))
+            if reward != rewards[i] or done != dones[i]:
+                raise ValueError("Environment {} differs from gym in step {}: reward {} vs {}, done {} vs {}".format(
+                    i, step, rewards[i], reward, dones[i], done))
+            expected = infos[i]["terminal_observation"] if done else observations[i]
+            max_difference = max(max_difference, np.max(np.abs(np.asarray(observation) - expected)))
+            if done:
+                env.reset()
+
+    return max_difference
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--env", default="CartPole-v1", type=str, help="Environment.")
+    parser.add_argument("--count", default=16, type=int, help="Number of environments.")
+    parser.add_argument("--steps", default=1000, type=int, help="Number of steps.")
+    parser.add_argument("--seed", default=42, type=int, help="Random seed.")
+    args = parser.parse_args()
+
+    print("Maximum observation difference from gym: {}".format(validate(args.env, args.count, args.steps, args.seed)))
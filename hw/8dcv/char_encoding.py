@@ -0,0 +1,68 @@
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+
+try:
+    unichr
+except NameError:
+    unichr = chr
+
+def unique_chars(strings):
+    """Find the distinct characters of the given strings using NumPy.
+
+    The strings are concatenated and converted to an array of code points by
+    encoding them in UTF-32 (or taken as bytes for byte strings).
+
+    Returns: (chars, inverse, lens)
+    chars: list of the distinct characters in the order of their first occurrence
+    inverse: for every character of the concatenated strings, its index in chars
+    lens: lengths of the strings
+    """
+    lens = np.array([len(string) for string in strings], np.int32)
+    text = "".join(strings)
+    if isinstance(text, bytes):
+        codes, to_char = np.frombuffer(text, np.uint8), chr
+    else:
+        codes, to_char = np.frombuffer(text.encode("utf-32-le", "surrogatepass"), np.uint32), unichr
+
+    # Number the distinct code points in the order of their first occurrence
+    codes, first_occurrences, inverse = np.unique(codes, return_index=True, return_inverse=True)
+    order = np.argsort(first_occurrences)
+    ranks = np.empty_like(order)
+    ranks[order] = np.arange(len(order))
+    return [to_char(code) for code in codes[order]], ranks[inverse.ravel()], lens
+
+def char_ids(chars, alphabet_map, alphabet=None, grow=True, transform=None, unk='<unk>'):
+    """Return the ids of the given characters in the alphabet_map.
+
+    Arguments:
+    chars: characters to map, e.g., the distinct characters from unique_chars
+    alphabet_map: dictionary from characters to ids
+    alphabet: if given, a list of characters extended together with alphabet_map
+    grow: if True, characters not in alphabet_map are added to it (in the given order,
+      with the next free ids), otherwise they are mapped to the id of unk
+    transform: if given, function applied to every character before the lookup
+    """
+    ids = np.zeros(len(chars), np.int32)
+    for i, char in enumerate(chars):
+        if transform is not None:
+            char = transform(char)
+        if char not in alphabet_map:
+            if not grow:
+                char = unk
+            else:
+                alphabet_map[char] = len(alphabet_map)
+                if alphabet is not None:
+                    alphabet.append(char)
+        ids[i] = alphabet_map[char]
+    return ids
+
+def encode_chars(strings, alphabet_map, alphabet=None, grow=True, transform=None, unk='<unk>'):
+    """Convert the characters of the given strings to ids, see char_ids.
+
+    Returns: (ids, lens), where ids are the flat character ids of all strings
+    and lens are the lengths of the strings.
+    """
+    chars, inverse, lens = unique_chars(strings)
+    return char_ids(chars, alphabet_map, alphabet, grow, transform, unk)[inverse], lens
@@ -1,8 +1,118 @@
 from __future__ import division
 from __future__ import print_function
 
+import hashlib
+import itertools
+import multiprocessing
+import os
+import pickle
+import shutil
+
 import numpy as np
 
+import char_encoding
+
+def _offsets(lens):
+    """Return the offsets of consecutive sequences with the given lengths."""
+    return np.concatenate([[0], np.cumsum(lens[:-1], dtype=np.int64)]).astype(np.int64)
+
+def _sentence_words(sentence_lens, sentence_offsets, sentences):
+    """Return the mask of the non-padding positions of the given sentences padded to the longest one,
+    together with the indices of the corresponding words in the flat word arrays."""
+    max_sentence_len = np.max(sentence_lens[sentences]) if len(sentences) else 0
+    mask = np.arange(max_sentence_len) < sentence_lens[sentences, np.newaxis]
+    return mask, (sentence_offsets[sentences, np.newaxis] + np.arange(max_sentence_len))[mask]
+
+def _read_only(batch):
+    """Mark all arrays of a (possibly nested) batch as read-only and return it."""
+    if isinstance(batch, (list, tuple)):
+        for part in batch:
+            _read_only(part)
+    else:
+        batch.setflags(write=False)
+    return batch
+
+def _sentence_chunks(lines, sentences):
+    """Split lines in vertical format into chunks, each containing the given number of sentences."""
+    chunk, chunk_sentences, in_sentence = [], 0, False
+    for line in lines:
+        if line.rstrip("\r\n"):
+            if not in_sentence:
+                if chunk_sentences == sentences:
+                    yield chunk
+                    chunk, chunk_sentences = [], 0
+                chunk_sentences += 1
+            in_sentence = True
+        else:
+            in_sentence = False
+        chunk.append(line)
+    if chunk_sentences:
+        yield chunk
+
+def _file_chunks(filename, chunk_bytes):
+    """Split a file in vertical format into byte ranges of roughly chunk_bytes,
+    each starting at the beginning of a sentence."""
+    size = os.path.getsize(filename)
+    boundaries = [0]
+    with open(filename, "rb") as file:
+        while boundaries[-1] < size:
+            # Skip the rest of the line at the approximate boundary and the sentence it belongs to
+            file.seek(boundaries[-1] + chunk_bytes)
+            file.readline()
+            while file.readline().rstrip(b"\r\n"):
+                pass
+            boundaries.append(min(file.tell(), size))
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+def _parse_chunk(args):
+    """Parse a byte range of a file in vertical format independently of any vocabularies.
+
+    Returns the sentence_lens and for every factor the distinct words in the order
+    of their first occurrence, the positions of the first occurrences (counted over
+    the words of all factors), the flat ids of the words into the distinct ones and
+    the strings of the sentences.
+    """
+    filename, start, end, factors = args
+    with open(filename, "rb") as file:
+        file.seek(start)
+        text = file.read(end - start)
+    if not isinstance(text, str):
+        text = text.decode("utf-8")
+
+    sentence_lens = []
+    words = [[] for f in range(factors)]
+    words_map = [{} for f in range(factors)]
+    first_positions = [[] for f in range(factors)]
+    ids = [[] for f in range(factors)]
+    strings = [[] for f in range(factors)]
+    in_sentence, position = False, 0
+    for line in text.split("\n"):
+        line = line.rstrip("\r")
+        if line:
+            columns = line.split("\t")
+            for f in range(factors):
+                word = columns[f] if f < len(columns) else '<pad>'
+                word_id = words_map[f].get(word)
+                if word_id is None:
+                    word_id = words_map[f][word] = len(words[f])
+                    words[f].append(word)
+                    first_positions[f].append(position)
+                ids[f].append(word_id)
+                # The distinct word objects are reused, so that they are pickled only once
+                if not in_sentence:
+                    strings[f].append([])
+                strings[f][-1].append(words[f][word_id])
+                position += 1
+            if not in_sentence:
+                sentence_lens.append(0)
+            sentence_lens[-1] += 1
+            in_sentence = True
+        else:
+            in_sentence = False
+
+    return np.array(sentence_lens, np.int32), words, [np.array(positions, np.int64) for positions in first_positions], \
+        [np.array(word_ids, np.int32) for word_ids in ids], strings
+
 class MorphoDataset:
     """Class capable of loading morphological datasets in vertical format."""
     FORMS = 0
@@ -10,14 +120,39 @@ class MorphoDataset:
     TAGS = 2
     FACTORS = 3
 
-    def __init__(self, filename, add_bow_eow=False, train=None):
+    def __init__(self, filename, add_bow_eow=False, train=None, cache_dir=None, processes=1):
         """Load dataset from file in vertical format.
 
         Arguments:
         add_bow_eow: Whether to add BOW/EOW characters to the word characters.
         train: If given, the words and words_map from the training data will be reused.
+        cache_dir: If given, the loaded dataset is stored in a compiled form in this directory,
+          and memory-mapped from there when the same dataset is loaded again. The cache is keyed
+          by the file content, add_bow_eow and the vocabularies of train.
+        processes: If larger than one, the file is split into chunks of sentences, which are
+          parsed in a pool of this number of processes; the resulting dataset including all
+          ids is identical to the one loaded by a single process.
         """
 
+        self._create_vocabularies(train)
+        self._fingerprint_source, self._fingerprint_value = (filename, add_bow_eow, train), None
+
+        cache_path = self._cache_path(filename, cache_dir)
+        if cache_path and os.path.isdir(cache_path):
+            self._load_cache(cache_path, train)
+        else:
+            self._load_file(filename, add_bow_eow, train, processes)
+            if cache_path:
+                self._save_cache(cache_path, train)
+        self._whole_data_batches = {}
+        self._evaluation_batches = {}
+
+        self._shard_index, self._shard_count = 0, 1
+        self._permutation = np.random.permutation(len(self._sentence_lens))
+        self._epoch_batches, self._epoch_words, self._epoch_padded_words = 0, 0, 0
+        self._padding_efficiency = None
+
+    def _create_vocabularies(self, train):
         # Create alphabet map
         self._alphabet_map = train._alphabet_map if train else {'<pad>': 0, '<unk>': 1, '<bow>': 2, '<eow>': 3}
         self._alphabet = train._alphabet if train else ['<pad>', '<unk>', '<bow>', '<eow>']
@@ -34,58 +169,222 @@ class MorphoDataset:
             self._data[f]['charseq_ids'] = []
             self._data[f]['strings'] = []
 
-        # Load the sentences
-        with open(filename, "r") as file:
-            in_sentence = False
-            for line in file:
-                line = line.rstrip("\r\n")
-                if line:
-                    factors = line.split("\t")
-                    for f in range(self.FACTORS):
+    @property
+    def _fingerprint(self):
+        # Identify the dataset by the file content, the options and the training data vocabularies;
+        # the file is hashed only when a cache is used by this dataset or by a dataset depending on it
+        if self._fingerprint_value is None:
+            self._fingerprint_value = self._compute_fingerprint(*self._fingerprint_source)
+        return self._fingerprint_value
+
+    def _compute_fingerprint(self, filename, add_bow_eow, train):
+        fingerprint = hashlib.sha1()
+        with open(filename, "rb") as file:
+            for block in iter(lambda: file.read(1 << 20), b""):
+                fingerprint.update(block)
+        fingerprint.update("add_bow_eow={},train={}".format(add_bow_eow, train._fingerprint if train else None).encode("utf-8"))
+        return fingerprint.hexdigest()
+
+    def _cache_path(self, filename, cache_dir):
+        return os.path.join(cache_dir, "{}-{}".format(os.path.basename(filename), self._fingerprint)) if cache_dir else None
+
+    def _parse(self, lines, add_bow_eow, train, strings=True):
+        """Parse sentences in vertical format, extending the vocabularies and the charseqs.
+
+        Returns the sentence_lens and for every factor the flat word_ids and charseq_ids.
+        The strings of the factors are extended only if strings is True.
+        """
+        sentence_lens = []
+        word_ids = [[] for f in range(self.FACTORS)]
+        charseq_ids = [[] for f in range(self.FACTORS)]
+        new_charseqs = []
+        in_sentence = False
+        for line in lines:
+            line = line.rstrip("\r\n")
+            if line:
+                factors = line.split("\t")
+                for f in range(self.FACTORS):
+                    word = factors[f] if f < len(factors) else '<pad>'
+                    if strings:
                         if not in_sentence:
-                            self._data[f]['word_ids'].append([])
-                            self._data[f]['charseq_ids'].append([])
                             self._data[f]['strings'].append([])
-                        word = factors[f] if f < len(factors) else '<pad>'
                         self._data[f]['strings'][-1].append(word)
 
-                        # Character-level information
-                        if word not in self._data[f]['charseqs_map']:
-                            self._data[f]['charseqs_map'][word] = len(self._data[f]['charseqs'])
-                            self._data[f]['charseqs'].append([])
-                            if add_bow_eow:
-                                self._data[f]['charseqs'][-1].append(self._alphabet_map['<bow>'])
-                            for c in word:
-                                if c not in self._alphabet_map:
-                                    if train:
-                                        c = '<unk>'
-                                    else:
-                                        self._alphabet_map[c] = len(self._alphabet)
-                                        self._alphabet.append(c)
-                                self._data[f]['charseqs'][-1].append(self._alphabet_map[c])
-                            if add_bow_eow:
-                                self._data[f]['charseqs'][-1].append(self._alphabet_map['<eow>'])
-                        self._data[f]['charseq_ids'][-1].append(self._data[f]['charseqs_map'][word])
-
-                        # Word-level information
-                        if word not in self._data[f]['words_map']:
-                            if train:
-                                word = '<unk>'
-                            else:
-                                self._data[f]['words_map'][word] = len(self._data[f]['words'])
-                                self._data[f]['words'].append(word)
-                        self._data[f]['word_ids'][-1].append(self._data[f]['words_map'][word])
-                    in_sentence = True
-                else:
-                    in_sentence = False
-
-        # Compute sentence lengths
-        sentences = len(self._data[0]['word_ids'])
-        self._sentence_lens = np.zeros([sentences], np.int32)
-        for i in range(len(self._data[0]['word_ids'])):
-            self._sentence_lens[i] = len(self._data[0]['word_ids'][i])
+                    # Character-level information
+                    if word not in self._data[f]['charseqs_map']:
+                        self._add_charseq(f, word, new_charseqs)
+                    charseq_ids[f].append(self._data[f]['charseqs_map'][word])
+
+                    # Word-level information
+                    if word not in self._data[f]['words_map']:
+                        if train:
+                            word = '<unk>'
+                        else:
+                            self._data[f]['words_map'][word] = len(self._data[f]['words'])
+                            self._data[f]['words'].append(word)
+                    word_ids[f].append(self._data[f]['words_map'][word])
+                if not in_sentence:
+                    sentence_lens.append(0)
+                sentence_lens[-1] += 1
+                in_sentence = True
+            else:
+                in_sentence = False
+        self._encode_charseqs(new_charseqs, add_bow_eow, train)
+
+        return np.array(sentence_lens, np.int32), [np.array(ids, np.int32) for ids in word_ids], \
+            [np.array(ids, np.int32) for ids in charseq_ids]
+
+    def _add_charseq(self, f, word, new_charseqs):
+        # Assign the charseq id, the characters are filled in by _encode_charseqs
+        self._data[f]['charseqs_map'][word] = len(self._data[f]['charseqs'])
+        self._data[f]['charseqs'].append(None)
+        new_charseqs.append((f, word))
+
+    def _encode_charseqs(self, new_charseqs, add_bow_eow, train):
+        # Convert the characters of all new charseqs at once, extending the alphabet
+        # in the order of the first occurrences of the characters
+        if not new_charseqs:
+            return
+        chars, lens = char_encoding.encode_chars([word for _, word in new_charseqs], self._alphabet_map,
+                                                 self._alphabet, grow=not train)
+        chars = chars.tolist()
+        for (f, word), offset, length in zip(new_charseqs, _offsets(lens), lens):
+            charseq = chars[offset:offset + length]
+            if add_bow_eow:
+                charseq = [self._alphabet_map['<bow>']] + charseq + [self._alphabet_map['<eow>']]
+            self._data[f]['charseqs'][self._data[f]['charseqs_map'][word]] = charseq
+
+    def _parse_parallel(self, filename, add_bow_eow, train, processes, chunk_bytes=1 << 20):
+        """Parse a file in vertical format in a process pool, see _parse.
+
+        The workers read and parse byte ranges of the file on their own. The chunks are
+        merged in order, and the words new to the vocabularies are added in the order
+        of their first occurrence, so that the ids are the same as in _parse.
+        """
+        sentence_lens, word_ids, charseq_ids = [], [[] for f in range(self.FACTORS)], [[] for f in range(self.FACTORS)]
+        pool = multiprocessing.Pool(processes)
+        try:
+            for chunk_lens, words, first_positions, ids, strings in pool.imap(
+                    _parse_chunk, ((filename, start, end, self.FACTORS) for start, end in _file_chunks(filename, chunk_bytes))):
+                # Extend the vocabularies by the words of all factors, ordered by the first occurrences,
+                # and map the distinct words of the chunk to the vocabularies
+                first_occurrences = sorted((position, f, i) for f in range(self.FACTORS)
+                                           for i, position in enumerate(first_positions[f]))
+                chunk_word_ids = [np.zeros(len(words[f]), np.int32) for f in range(self.FACTORS)]
+                chunk_charseq_ids = [np.zeros(len(words[f]), np.int32) for f in range(self.FACTORS)]
+                new_charseqs = []
+                for _, f, i in first_occurrences:
+                    word, words_map, charseqs_map = words[f][i], self._data[f]['words_map'], self._data[f]['charseqs_map']
+                    if word not in charseqs_map:
+                        self._add_charseq(f, word, new_charseqs)
+                    chunk_charseq_ids[f][i] = charseqs_map[word]
+                    if word not in words_map:
+                        if train:
+                            word = '<unk>'
+                        else:
+                            words_map[word] = len(self._data[f]['words'])
+                            self._data[f]['words'].append(word)
+                    chunk_word_ids[f][i] = words_map[word]
+                self._encode_charseqs(new_charseqs, add_bow_eow, train)
+
+                sentence_lens.append(chunk_lens)
+                for f in range(self.FACTORS):
+                    word_ids[f].append(chunk_word_ids[f][ids[f]])
+                    charseq_ids[f].append(chunk_charseq_ids[f][ids[f]])
+                    self._data[f]['strings'].extend(strings[f])
+        finally:
+            pool.close()
+            pool.join()
+
+        return np.concatenate([np.zeros([0], np.int32)] + sentence_lens), \
+            [np.concatenate([np.zeros([0], np.int32)] + ids) for ids in word_ids], \
+            [np.concatenate([np.zeros([0], np.int32)] + ids) for ids in charseq_ids]
+
+    def _load_file(self, filename, add_bow_eow, train, processes=1):
+        # Load the sentences
+        if processes > 1:
+            self._sentence_lens, word_ids, charseq_ids = self._parse_parallel(filename, add_bow_eow, train, processes)
+        else:
+            with open(filename, "r") as file:
+                self._sentence_lens, word_ids, charseq_ids = self._parse(file, add_bow_eow, train)
+        self._sentence_offsets = _offsets(self._sentence_lens)
+        for f in range(self.FACTORS):
+            self._data[f]['word_ids'] = word_ids[f]
+            self._data[f]['charseq_ids'] = charseq_ids[f]
 
-        self._permutation = np.random.permutation(len(self._sentence_lens))
+        self._flatten_charseqs()
+
+    def _flatten_charseqs(self):
+        # Store the charseqs also in a flat form
+        self._charseq_chars, self._charseq_offsets, self._charseq_lens = [], [], []
+        for f in range(self.FACTORS):
+            self._charseq_lens.append(np.array([len(charseq) for charseq in self._data[f]['charseqs']], np.int32))
+            self._charseq_offsets.append(_offsets(self._charseq_lens[-1]))
+            self._charseq_chars.append(np.fromiter(itertools.chain.from_iterable(self._data[f]['charseqs']), np.int32,
+                                                   np.sum(self._charseq_lens[-1])))
+
+    def _save_cache(self, path, train):
+        # Write a temporary directory first, so that a partially written cache is never used
+        tmp_path = "{}.tmp{}".format(path, os.getpid())
+        os.makedirs(tmp_path)
+
+        vocabularies = {'charseqs': []}
+        if not train:
+            vocabularies['alphabet'] = self._alphabet
+            vocabularies['words'] = [self._data[f]['words'] for f in range(self.FACTORS)]
+        for f in range(self.FACTORS):
+            charseqs = [None] * len(self._data[f]['charseqs_map'])
+            for charseq, charseq_id in self._data[f]['charseqs_map'].items():
+                charseqs[charseq_id] = charseq
+            vocabularies['charseqs'].append(charseqs)
+        # Pickle keeps the native str type of the words (bytes in Python 2), which json would not
+        with open(os.path.join(tmp_path, "vocabularies.pickle"), "wb") as file:
+            pickle.dump(vocabularies, file, protocol=2)
+
+        np.save(os.path.join(tmp_path, "sentence_lens.npy"), self._sentence_lens)
+        for f in range(self.FACTORS):
+            np.save(os.path.join(tmp_path, "word_ids-{}.npy".format(f)), self._data[f]['word_ids'])
+            np.save(os.path.join(tmp_path, "charseq_ids-{}.npy".format(f)), self._data[f]['charseq_ids'])
+            np.save(os.path.join(tmp_path, "charseq_chars-{}.npy".format(f)), self._charseq_chars[f])
+            np.save(os.path.join(tmp_path, "charseq_lens-{}.npy".format(f)), self._charseq_lens[f])
+
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # The same cache has been written concurrently by another process
+            shutil.rmtree(tmp_path)
+
+    def _load_cache(self, path, train, strings=True):
+        with open(os.path.join(path, "vocabularies.pickle"), "rb") as file:
+            vocabularies = pickle.load(file)
+        if not train:
+            self._alphabet = vocabularies['alphabet']
+            self._alphabet_map = dict((c, i) for i, c in enumerate(self._alphabet))
+            for f in range(self.FACTORS):
+                self._data[f]['words'] = vocabularies['words'][f]
+                self._data[f]['words_map'] = dict((word, i) for i, word in enumerate(self._data[f]['words']))
+
+        self._sentence_lens = np.load(os.path.join(path, "sentence_lens.npy"))
+        self._sentence_offsets = _offsets(self._sentence_lens)
+
+        self._charseq_chars, self._charseq_offsets, self._charseq_lens = [], [], []
+        for f in range(self.FACTORS):
+            self._data[f]['word_ids'] = np.load(os.path.join(path, "word_ids-{}.npy".format(f)), mmap_mode="r")
+            self._data[f]['charseq_ids'] = np.load(os.path.join(path, "charseq_ids-{}.npy".format(f)), mmap_mode="r")
+            self._charseq_chars.append(np.load(os.path.join(path, "charseq_chars-{}.npy".format(f)), mmap_mode="r"))
+            self._charseq_lens.append(np.load(os.path.join(path, "charseq_lens-{}.npy".format(f)), mmap_mode="r"))
+            self._charseq_offsets.append(_offsets(self._charseq_lens[-1]))
+
+            # Recreate the charseqs and the strings
+            charseqs = vocabularies['charseqs'][f]
+            self._data[f]['charseqs_map'] = dict((charseq, i) for i, charseq in enumerate(charseqs))
+            charseq_chars = self._charseq_chars[f].tolist()
+            self._data[f]['charseqs'] = [charseq_chars[offset:offset + length]
+                                         for offset, length in zip(self._charseq_offsets[f], self._charseq_lens[f])]
+            if strings:
+                charseq_ids = self._data[f]['charseq_ids'].tolist()
+                self._data[f]['strings'] = [[charseqs[charseq_id] for charseq_id in charseq_ids[offset:offset + length]]
+                                            for offset, length in zip(self._sentence_offsets, self._sentence_lens)]
 
     @property
     def alphabet(self):
@@ -95,16 +394,30 @@ class MorphoDataset:
     def sentence_lens(self):
         return self._sentence_lens
 
+    @property
+    def sentence_offsets(self):
+        """Return the offsets of the sentences in the flat word_ids and charseq_ids factor arrays."""
+        return self._sentence_offsets
+
+    @property
+    def padding_efficiency(self):
+        """Return the ratio of the real words to all batch positions including padding,
+        measured over the batches of the last finished epoch."""
+        return self._padding_efficiency
+
     @property
     def factors(self):
         """Return the factors of the dataset.
 
         The result is an array of factors, each a dictionary containing:
         strings: Strings of the original words.
-        word_ids: Word ids of the original words (uses <unk> and <pad>).
+        word_ids: Word ids of the original words (uses <unk> and <pad>), stored
+          as a flat array of all the sentences; the words of sentence i are
+          word_ids[sentence_offsets[i]:sentence_offsets[i] + sentence_lens[i]].
         words_map: String -> word_id map.
         words: Word_id -> string map.
-        charseq_ids: Character_sequence ids of the original words.
+        charseq_ids: Character_sequence ids of the original words, stored
+          as a flat array in the same way as word_ids.
         charseqs_map: String -> character_sequence_id map.
         charseqs: Character_sequence_id -> [characters], where character is an index
           to the dataset alphabet.
@@ -112,11 +425,15 @@ class MorphoDataset:
 
         return self._data
 
-    def next_batch(self, batch_size, including_charseqs=False):
+    def next_batch(self, batch_size, including_charseqs=False, bucketing=0):
         """Return the next batch.
 
         Arguments:
         including_charseqs: if True, also batch_charseq_ids, batch_charseqs and batch_charseq_lens are returned
+        bucketing: If nonzero, sentences of similar lengths are batched together to reduce
+          padding. The sentences are sorted by length and split into buckets of `bucketing`
+          batches; the sentences are shuffled inside the buckets and the resulting batches
+          are shuffled. Takes effect when passed to the first next_batch of an epoch.
 
         Returns: (sentence_lens, batch_word_ids[, batch_charseq_ids, batch_charseqs])
         sequence_lens: batch of sentence_lens
@@ -131,26 +448,135 @@ class MorphoDataset:
           Returned only if including_charseqs is True.
         """
 
+        if bucketing and not self._epoch_batches:
+            self._permutation = self._bucketed_permutation(self._permutation, batch_size, bucketing)
         batch_size = min(batch_size, len(self._permutation))
         batch_perm = self._permutation[:batch_size]
         self._permutation = self._permutation[batch_size:]
+        self._epoch_batches += 1
+        self._epoch_words += np.sum(self._sentence_lens[batch_perm])
+        self._epoch_padded_words += batch_size * np.max(self._sentence_lens[batch_perm])
         return self._next_batch(batch_perm, including_charseqs)
 
+    def next_batch_by_tokens(self, max_tokens, including_charseqs=False):
+        """Return the next batch containing at most max_tokens words including padding.
+
+        Sentences are taken from the current permutation as long as the padded batch size
+        batch_size * max_sentence_len does not exceed max_tokens; at least one sentence
+        is always returned. Returns the same results as next_batch.
+        """
+
+        # Every sentence has at least one word, so at most max_tokens sentences can fit
+        sentence_lens = self._sentence_lens[self._permutation[:max_tokens]]
+        padded_sizes = np.maximum.accumulate(sentence_lens) * np.arange(1, len(sentence_lens) + 1)
+        return self.next_batch(max(1, np.searchsorted(padded_sizes, max_tokens, side="right")), including_charseqs)
+
     def epoch_finished(self):
         if len(self._permutation) == 0:
-            self._permutation = np.random.permutation(len(self._sentence_lens))
+            self._start_epoch()
+            self._padding_efficiency = self._epoch_words / self._epoch_padded_words if self._epoch_padded_words else None
+            self._epoch_batches, self._epoch_words, self._epoch_padded_words = 0, 0, 0
             return True
         return False
 
+    def _start_epoch(self):
+        self._permutation = self._shard_permutation(np.random.permutation(len(self._sentence_lens)))
+
+    def shard(self, index, count):
+        """Iterate only over the given shard of every epoch, for data-parallel training.
+
+        Every epoch permutation is generated from the global NumPy random generator as
+        usual and split into count shards of equal size, the shard index being used;
+        the last len % count sentences of the permutation are skipped in the epoch.
+        When all workers seed the generator identically and use the same options,
+        their shards of every epoch are disjoint and have the same number of batches.
+        Must be called at the beginning of an epoch, before the first batch.
+        """
+        if not 0 <= index < count:
+            raise ValueError("Shard index {} is not in range [0, {})".format(index, count))
+        if self._epoch_batches or len(self._permutation) != len(self._sentence_lens):
+            raise ValueError("The dataset can be sharded only once, at the beginning of an epoch")
+        self._shard_index, self._shard_count = index, count
+        self._permutation = self._shard_permutation(self._permutation)
+
+    def _shard_permutation(self, permutation):
+        if self._shard_count == 1:
+            return permutation
+        return permutation[:len(permutation) - len(permutation) % self._shard_count][self._shard_index::self._shard_count]
+
+    def get_state(self):
+        """Return the iteration state, which can be pickled and later restored by set_state.
+
+        The state contains the rest of the current epoch permutation, the statistics
+        of the current epoch and the state of the global NumPy random generator, which
+        generates the permutations of the following epochs; after set_state, the dataset
+        returns exactly the same batches as it would have without interruption. When
+        batches are prefetched, the batches waiting in the prefetcher are already removed
+        from the permutation, so use the state of BatchPrefetcher created with states=True.
+        """
+        return {'permutation': np.array(self._permutation), 'epoch_batches': self._epoch_batches,
+                'epoch_words': self._epoch_words, 'epoch_padded_words': self._epoch_padded_words,
+                'padding_efficiency': self._padding_efficiency, 'random_state': np.random.get_state()}
+
+    def set_state(self, state):
+        """Restore the iteration state returned by get_state."""
+        self._permutation = np.array(state['permutation'])
+        self._epoch_batches, self._epoch_words, self._epoch_padded_words = \
+            state['epoch_batches'], state['epoch_words'], state['epoch_padded_words']
+        self._padding_efficiency = state['padding_efficiency']
+        np.random.set_state(state['random_state'])
+
     def whole_data_as_batch(self, including_charseqs=False):
         """Return the whole dataset in the same result as next_batch.
 
         Arguments:
         including_charseqs: if True, also batch_charseq_ids, batch_charseqs and batch_charseq_lens are returned
 
-        Returns the same results as next_batch.
+        Returns the same results as next_batch. The batches are computed only once for
+        every combination of arguments and returned read-only; the data never change
+        after loading, any code replacing them must reset _whole_data_batches.
         """
-        return self._next_batch(np.arange(len(self.sentence_lens)), including_charseqs)
+        if including_charseqs not in self._whole_data_batches:
+            self._whole_data_batches[including_charseqs] = \
+                _read_only(self._next_batch(np.arange(len(self.sentence_lens)), including_charseqs))
+        return self._whole_data_batches[including_charseqs]
+
+    def evaluation_batches(self, batch_size, including_charseqs=False):
+        """Return the whole dataset split into batches of sentences sorted by length.
+
+        Arguments:
+        batch_size: Number of sentences in every batch (except possibly the last one).
+        including_charseqs: if True, also batch_charseq_ids, batch_charseqs and batch_charseq_lens are returned
+
+        Returns: list of (sentence_ids, batch) pairs, where batch has the same form as
+        the results of next_batch and sentence_ids are the indices of its sentences
+        in the dataset, which allow to restore the original order of predictions.
+        The batches are computed only once for every combination of arguments and
+        are read-only, the same as in whole_data_as_batch.
+        """
+        key = (batch_size, including_charseqs)
+        if key not in self._evaluation_batches:
+            order = np.argsort(self._sentence_lens, kind="mergesort")
+            self._evaluation_batches[key] = [
+                (_read_only(order[start:start + batch_size]),
+                 _read_only(self._next_batch(order[start:start + batch_size], including_charseqs)))
+                for start in range(0, len(order), batch_size)]
+        return self._evaluation_batches[key]
+
+    def _bucketed_permutation(self, permutation, batch_size, bucketing):
+        # Sort by length; the stable sort keeps the random order of sentences of the same length
+        permutation = permutation[np.argsort(self._sentence_lens[permutation], kind="mergesort")]
+
+        # Shuffle the sentences inside the buckets, each consisting of `bucketing` batches
+        bucket_size = batch_size * bucketing
+        for start in range(0, len(permutation), bucket_size):
+            permutation[start:start + bucket_size] = np.random.permutation(permutation[start:start + bucket_size])
+
+        # Shuffle the full batches, keeping the possibly incomplete last batch at the end
+        batches = len(permutation) // batch_size
+        batch_order = np.random.permutation(batches)
+        return np.concatenate([permutation[:batches * batch_size].reshape([batches, batch_size])[batch_order].ravel(),
+                               permutation[batches * batch_size:]])
 
     def _next_batch(self, batch_perm, including_charseqs):
         batch_size = len(batch_perm)
@@ -159,12 +585,14 @@ class MorphoDataset:
         batch_sentence_lens = self._sentence_lens[batch_perm]
         max_sentence_len = np.max(batch_sentence_lens)
 
+        # Mask of the non-padding batch positions and the corresponding indices to the flat word arrays
+        batch_mask, batch_words = _sentence_words(self._sentence_lens, self._sentence_offsets, batch_perm)
+
         # Word-level data
         batch_word_ids = []
         for f in range(self.FACTORS):
             batch_word_ids.append(np.zeros([batch_size, max_sentence_len], np.int32))
-            for i in range(batch_size):
-                batch_word_ids[-1][i, 0:batch_sentence_lens[i]] = self._data[f]['word_ids'][batch_perm[i]]
+            batch_word_ids[-1][batch_mask] = self._data[f]['word_ids'][batch_words]
 
         if not including_charseqs:
             return self._sentence_lens[batch_perm], batch_word_ids
@@ -172,21 +600,149 @@ class MorphoDataset:
         # Character-level data
         batch_charseq_ids, batch_charseqs, batch_charseq_lens = [], [], []
         for f in range(self.FACTORS):
+            # Number the unique charseqs in the order of their first occurrence in the batch
+            charseqs, first_occurrences, charseq_ids = np.unique(
+                self._data[f]['charseq_ids'][batch_words], return_index=True, return_inverse=True)
+            order = np.argsort(first_occurrences)
+            charseqs = charseqs[order]
+            charseqs_map = np.empty_like(order)
+            charseqs_map[order] = np.arange(len(order))
+
             batch_charseq_ids.append(np.zeros([batch_size, max_sentence_len], np.int32))
-            charseqs_map = {}
-            charseqs = []
-            charseq_lens = []
-            for i in range(batch_size):
-                for j, charseq_id in enumerate(self._data[f]['charseq_ids'][batch_perm[i]]):
-                    if charseq_id not in charseqs_map:
-                        charseqs_map[charseq_id] = len(charseqs)
-                        charseqs.append(self._data[f]['charseqs'][charseq_id])
-                    batch_charseq_ids[-1][i, j] = charseqs_map[charseq_id]
-
-            batch_charseq_lens.append(np.array([len(charseq) for charseq in charseqs], np.int32))
-            batch_charseqs.append(np.zeros([len(charseqs), np.max(batch_charseq_lens[-1])], np.int32))
-            for i in range(len(charseqs)):
-                batch_charseqs[-1][i, 0:len(charseqs[i])] = charseqs[i]
+            batch_charseq_ids[-1][batch_mask] = charseqs_map[charseq_ids]
+
+            batch_charseq_lens.append(self._charseq_lens[f][charseqs])
+            charseqs_mask = np.arange(np.max(batch_charseq_lens[-1])) < batch_charseq_lens[-1][:, np.newaxis]
+            batch_charseqs.append(np.zeros(charseqs_mask.shape, np.int32))
+            batch_charseqs[-1][charseqs_mask] = self._charseq_chars[f][
+                (self._charseq_offsets[f][charseqs, np.newaxis] + np.arange(charseqs_mask.shape[1]))[charseqs_mask]]
 
         return self._sentence_lens[batch_perm], batch_word_ids, batch_charseq_ids, batch_charseqs, batch_charseq_lens
 
+
+class MorphoDatasetStream(MorphoDataset):
+    """Class streaming morphological datasets in vertical format in shuffled batches.
+
+    Only the vocabularies and a shuffle buffer of sentences are kept in memory.
+    The sentence_lens, sentence_offsets and the word_ids and charseq_ids of the
+    factors describe the sentences currently in the shuffle buffer, and the
+    strings of the factors are not available.
+    """
+
+    def __init__(self, filename, add_bow_eow=False, train=None, cache_dir=None, buffer_size=10000):
+        """Prepare streaming of a dataset from file in vertical format.
+
+        The vocabularies are built in one pass over the file; afterwards, every epoch
+        reads the sentences in chunks of buffer_size // 2, and batches are sampled
+        randomly from a shuffle buffer holding up to buffer_size sentences.
+
+        Arguments:
+        add_bow_eow: Whether to add BOW/EOW characters to the word characters.
+        train: If given, the words and words_map from the training data will be reused.
+        cache_dir: If given and the compiled dataset created by MorphoDataset exists
+          there, the vocabularies are loaded from it and the epochs read the chunks
+          of sentences in random order from the memory-mapped cache instead of the file.
+        buffer_size: Maximum number of sentences in the shuffle buffer.
+        """
+
+        self._filename, self._add_bow_eow, self._train = filename, add_bow_eow, train
+        self._chunk_size = max(1, buffer_size // 2)
+
+        self._create_vocabularies(train)
+        self._fingerprint_source, self._fingerprint_value = (filename, add_bow_eow, train), None
+
+        cache_path = self._cache_path(filename, cache_dir)
+        self._cache = None
+        if cache_path and os.path.isdir(cache_path):
+            self._load_cache(cache_path, train, strings=False)
+            self._cache = (self._sentence_lens, self._sentence_offsets,
+                           [self._data[f]['word_ids'] for f in range(self.FACTORS)],
+                           [self._data[f]['charseq_ids'] for f in range(self.FACTORS)])
+        else:
+            with open(filename, "r") as file:
+                for chunk in _sentence_chunks(file, self._chunk_size):
+                    self._parse(chunk, add_bow_eow, train, strings=False)
+            self._flatten_charseqs()
+
+        # Start with an empty shuffle buffer
+        self._sentence_lens = np.zeros([0], np.int32)
+        self._sentence_offsets = np.zeros([0], np.int64)
+        for f in range(self.FACTORS):
+            self._data[f]['word_ids'] = np.zeros([0], np.int32)
+            self._data[f]['charseq_ids'] = np.zeros([0], np.int32)
+        self._permutation = np.zeros([0], np.int64)
+        self._start_epoch()
+
+        self._epoch_batches, self._epoch_words, self._epoch_padded_words = 0, 0, 0
+        self._padding_efficiency = None
+
+    def _chunks(self):
+        # Yield chunks of sentences as (sentence_lens, word_ids, charseq_ids) triples
+        if self._cache:
+            sentence_lens, sentence_offsets, word_ids, charseq_ids = self._cache
+            for start in np.random.permutation(np.arange(0, len(sentence_lens), self._chunk_size)):
+                chunk_lens = np.array(sentence_lens[start:start + self._chunk_size])
+                words = slice(sentence_offsets[start], sentence_offsets[start] + np.sum(chunk_lens))
+                yield chunk_lens, [np.array(ids[words]) for ids in word_ids], [np.array(ids[words]) for ids in charseq_ids]
+        else:
+            with open(self._filename, "r") as file:
+                for chunk in _sentence_chunks(file, self._chunk_size):
+                    yield self._parse(chunk, self._add_bow_eow, self._train, strings=False)
+
+    def _fill_buffer(self, sentences):
+        # Append chunks to the buffer, until it contains at least the given number
+        # of sentences not returned yet and at least buffer_size // 2 of them
+        while len(self._permutation) < max(sentences, self._chunk_size) and self._source is not None:
+            chunk = next(self._source, None)
+            if chunk is None:
+                self._source = None
+                break
+
+            # Keep only the sentences not returned yet and append the chunk
+            chunk_lens, chunk_word_ids, chunk_charseq_ids = chunk
+            _, kept_words = _sentence_words(self._sentence_lens, self._sentence_offsets, self._permutation)
+            self._sentence_lens = np.concatenate([self._sentence_lens[self._permutation], chunk_lens])
+            self._sentence_offsets = _offsets(self._sentence_lens)
+            for f in range(self.FACTORS):
+                self._data[f]['word_ids'] = np.concatenate([self._data[f]['word_ids'][kept_words], chunk_word_ids[f]])
+                self._data[f]['charseq_ids'] = np.concatenate([self._data[f]['charseq_ids'][kept_words], chunk_charseq_ids[f]])
+            self._permutation = np.random.permutation(len(self._sentence_lens))
+
+    def next_batch(self, batch_size, including_charseqs=False, bucketing=0):
+        """Return the next batch, see MorphoDataset.next_batch; bucketing is not supported.
+
+        The batch is taken from the shuffle buffer, so it contains at most buffer_size
+        sentences; batches larger than buffer_size // 2 may be shorter than batch_size.
+        """
+        if bucketing:
+            raise ValueError("Bucketing is not supported by MorphoDatasetStream")
+        self._fill_buffer(min(batch_size, self._chunk_size))
+        return MorphoDataset.next_batch(self, batch_size, including_charseqs)
+
+    def next_batch_by_tokens(self, max_tokens, including_charseqs=False):
+        # Filling the buffer with max_tokens sentences would exceed buffer_size for large
+        # budgets, so the batch is taken from at least buffer_size // 2 buffered sentences
+        self._fill_buffer(min(max_tokens, self._chunk_size))
+        return MorphoDataset.next_batch_by_tokens(self, max_tokens, including_charseqs)
+
+    def epoch_finished(self):
+        self._fill_buffer(1)
+        return MorphoDataset.epoch_finished(self)
+
+    def _start_epoch(self):
+        self._source = self._chunks()
+
+    def whole_data_as_batch(self, including_charseqs=False):
+        raise ValueError("MorphoDatasetStream cannot return the whole data as a batch")
+
+    def evaluation_batches(self, batch_size, including_charseqs=False):
+        raise ValueError("MorphoDatasetStream cannot return the whole data as batches")
+
+    def shard(self, index, count):
+        raise ValueError("MorphoDatasetStream does not support sharding")
+
+    def get_state(self):
+        raise ValueError("MorphoDatasetStream does not support saving the iteration state")
+
+    def set_state(self, state):
+        raise ValueError("MorphoDatasetStream does not support saving the iteration state")
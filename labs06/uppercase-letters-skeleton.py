@@ -8,46 +8,40 @@ import numpy as np
 import tensorflow as tf
 import tensorflow.contrib.layers as tf_layers
 
+import batch_prefetcher
+import char_encoding
+
 class Dataset:
     def __init__(self, filename, alphabet = None):
         # Load the sentences
         sentences = []
-        with open(filename, "rw") as file:
+        with open(filename, "r") as file:
             for line in file:
                 sentences.append(line.rstrip("\r\n"))
 
-        # Compute sentence lengths
-        self._sentence_lens = np.zeros([len(sentences)], np.int32)
-        for i in range(len(sentences)):
-            self._sentence_lens[i] = len(sentences[i])
-        max_sentence_len = np.max(self._sentence_lens)
-
         # Create alphabet_map
         alphabet_map = {'<pad>': 0, '<unk>': 1}
         if alphabet is not None:
             for index, letter in enumerate(alphabet):
                 alphabet_map[letter] = index
 
-        # Remap input characters using the alphabet_map
-        self._sentences = np.zeros([len(sentences), max_sentence_len], np.int32)
-        self._labels = np.zeros([len(sentences), max_sentence_len], np.int32)
-        for i in range(len(sentences)):
-            for j in range(len(sentences[i])):
-                char = sentences[i][j].lower()
-                if char not in alphabet_map:
-                    if alphabet is None:
-                        alphabet_map[char] = len(alphabet_map)
-                    else:
-                        char = '<unk>'
-                self._sentences[i, j] = alphabet_map[char]
-                self._labels[i, j] = 0 if sentences[i][j].lower() == sentences[i][j] else 1
+        # Remap lowercased input characters using the alphabet_map, labeling the uppercase ones.
+        # The characters of all sentences are stored in flat arrays, indexed by sentence offsets.
+        chars, inverse, self._sentence_lens = char_encoding.unique_chars(sentences)
+        self._sentence_offsets = np.concatenate([[0], np.cumsum(self._sentence_lens[:-1], dtype=np.int64)]).astype(np.int64)
+        self._chars = char_encoding.char_ids(chars, alphabet_map, grow=alphabet is None,
+                                             transform=lambda char: char.lower())[inverse]
+        self._char_labels = np.array([char.lower() != char for char in chars], np.int32)[inverse]
 
         # Compute alphabet
         self._alphabet = [""] * len(alphabet_map)
-        for key, value in alphabet_map.iteritems():
+        for key, value in alphabet_map.items():
             self._alphabet[value] = key
 
-        self._permutation = np.random.permutation(len(self._sentences))
+        self._sorted_batches = {}
+
+        self._shard_index, self._shard_count = 0, 1
+        self._permutation = np.random.permutation(len(self._sentence_lens))
 
     @property
     def alphabet(self):
@@ -55,7 +49,8 @@ class Dataset:
 
     @property
     def sentences(self):
-        return self._sentences
+        # The whole data padded to the longest sentence; prefer next_batch or sorted_batches
+        return self._batch(np.arange(len(self._sentence_lens)))[0]
 
     @property
     def sentence_lens(self):
@@ -63,21 +58,79 @@ class Dataset:
 
     @property
     def labels(self):
-        return self._labels
+        return self._batch(np.arange(len(self._sentence_lens)))[2]
+
+    def _batch(self, batch_perm):
+        # Pad the sentences only to the longest sentence in the batch
+        batch_sentence_lens = self._sentence_lens[batch_perm]
+        batch_len = np.max(batch_sentence_lens) if len(batch_perm) else 0
+        batch_mask = np.arange(batch_len) < batch_sentence_lens[:, np.newaxis]
+        batch_chars = (self._sentence_offsets[batch_perm, np.newaxis] + np.arange(batch_len))[batch_mask]
+        batch_sentences = np.zeros([len(batch_perm), batch_len], np.int32)
+        batch_sentences[batch_mask] = self._chars[batch_chars]
+        batch_labels = np.zeros([len(batch_perm), batch_len], np.int32)
+        batch_labels[batch_mask] = self._char_labels[batch_chars]
+        return batch_sentences, batch_sentence_lens, batch_labels
 
     def next_batch(self, batch_size):
         batch_size = min(batch_size, len(self._permutation))
         batch_perm = self._permutation[:batch_size]
         self._permutation = self._permutation[batch_size:]
-        batch_len = np.max(self._sentence_lens[batch_perm])
-        return self._sentences[batch_perm, 0:batch_len], self._sentence_lens[batch_perm], self._labels[batch_perm, 0:batch_len]
+        return self._batch(batch_perm)
+
+    def sorted_batches(self, batch_size):
+        # Return the whole data in batches of sentences sorted by length, to minimize padding
+        # (independently of the training permutation). The batches are computed only once
+        # for every batch_size and are read-only.
+        if batch_size not in self._sorted_batches:
+            order = np.argsort(self._sentence_lens, kind="mergesort")
+            self._sorted_batches[batch_size] = [self._batch(order[start:start + batch_size])
+                                                for start in range(0, len(order), batch_size)]
+            for batch in self._sorted_batches[batch_size]:
+                for array in batch:
+                    array.setflags(write=False)
+        return self._sorted_batches[batch_size]
+
+    def next_batch_by_tokens(self, max_tokens):
+        # Take sentences while the padded batch size batch_size * batch_len fits in max_tokens,
+        # but always at least one sentence (and at most max_tokens of them)
+        sentence_lens = self._sentence_lens[self._permutation[:max_tokens]]
+        padded_sizes = np.maximum.accumulate(sentence_lens) * np.arange(1, len(sentence_lens) + 1)
+        return self.next_batch(max(1, np.searchsorted(padded_sizes, max_tokens, side="right")))
 
     def epoch_finished(self):
         if len(self._permutation) == 0:
-            self._permutation = np.random.permutation(len(self._sentences))
+            self._permutation = self._shard_permutation(np.random.permutation(len(self._sentence_lens)))
             return True
         return False
 
+    def shard(self, index, count):
+        # Iterate only over the given shard of every epoch, for data-parallel training. The epoch
+        # permutations, identical in all identically seeded workers, are split into count shards
+        # of equal size (skipping the last len % count sentences). Call before the first batch.
+        if not 0 <= index < count:
+            raise ValueError("Shard index {} is not in range [0, {})".format(index, count))
+        if len(self._permutation) != len(self._sentence_lens):
+            raise ValueError("The dataset can be sharded only once, at the beginning of an epoch")
+        self._shard_index, self._shard_count = index, count
+        self._permutation = self._shard_permutation(self._permutation)
+
+    def _shard_permutation(self, permutation):
+        if self._shard_count == 1:
+            return permutation
+        return permutation[:len(permutation) - len(permutation) % self._shard_count][self._shard_index::self._shard_count]
+
+    def get_state(self):
+        # Return the iteration state, consisting of the rest of the current epoch permutation
+        # and the global NumPy random generator state (which generates the following epochs).
+        # The state can be pickled and restored by set_state to continue with the same batches;
+        # when batches are prefetched, use the state of BatchPrefetcher created with states=True.
+        return {'permutation': np.array(self._permutation), 'random_state': np.random.get_state()}
+
+    def set_state(self, state):
+        self._permutation = np.array(state['permutation'])
+        np.random.set_state(state['random_state'])
+
 
 class Network:
     def __init__(self, alphabet_size, rnn_cell, rnn_cell_dim, logdir, expname, threads=1, seed=42):
@@ -105,11 +158,11 @@ class Network:
             self.labels = tf.placeholder(tf.int64, [None, None])
 
             # TODO
-            # accuracy = ...
+            # self.accuracy = ...
             # self.training = ...
 
             self.dataset_name = tf.placeholder(tf.string, [])
-            self.summary = tf.scalar_summary(self.dataset_name+"/accuracy", accuracy)
+            self.summary = tf.scalar_summary(self.dataset_name+"/accuracy", self.accuracy)
 
             # Initialize variables
             self.session.run(tf.initialize_all_variables())
@@ -124,9 +177,15 @@ class Network:
                                        self.labels: labels, self.dataset_name: "train"})
         self.summary_writer.add_summary(summary, self.training_step)
 
-    def evaluate(self, sentences, sentence_lens, labels, dataset_name):
-        summary = self.session.run(self.summary, {self.sentences: sentences, self.sentence_lens: sentence_lens,
-                                                  self.labels: labels, self.dataset_name: dataset_name})
+    def evaluate(self, dataset, dataset_name, batch_size):
+        # Evaluate over batches of similar-length sentences, weighting the accuracies by the number of characters
+        correct, total = 0, 0
+        for sentences, sentence_lens, labels in dataset.sorted_batches(batch_size):
+            accuracy = self.session.run(self.accuracy, {self.sentences: sentences, self.sentence_lens: sentence_lens,
+                                                        self.labels: labels})
+            correct += accuracy * np.sum(sentence_lens)
+            total += np.sum(sentence_lens)
+        summary = tf.Summary(value=[tf.Summary.Value(tag=dataset_name+"/accuracy", simple_value=correct / total)])
         self.summary_writer.add_summary(summary, self.training_step)
 
 
@@ -138,10 +197,13 @@ if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument("--batch_size", default=16, type=int, help="Batch size.")
+    parser.add_argument("--batch_tokens", default=0, type=int, help="If nonzero, batch size in padded words instead of sentences.")
     parser.add_argument("--data_train", default="en-ud-train.txt", type=str, help="Training data file.")
     parser.add_argument("--data_dev", default="en-ud-dev.txt", type=str, help="Development data file.")
     parser.add_argument("--data_test", default="en-ud-test.txt", type=str, help="Testing data file.")
     parser.add_argument("--epochs", default=10, type=int, help="Number of epochs.")
+    parser.add_argument("--evaluation_batch_size", default=256, type=int, help="Batch size for evaluation.")
+    parser.add_argument("--prefetch", default=2, type=int, help="Number of batches prepared in background (0 disables prefetching).")
     parser.add_argument("--logdir", default="logs", type=str, help="Logdir name.")
     parser.add_argument("--rnn_cell", default="LSTM", type=str, help="RNN cell type.")
     parser.add_argument("--rnn_cell_dim", default=10, type=int, help="RNN cell dimension.")
@@ -158,11 +220,15 @@ if __name__ == "__main__":
     network = Network(alphabet_size=len(data_train.alphabet), rnn_cell=args.rnn_cell, rnn_cell_dim=args.rnn_cell_dim, logdir=args.logdir, expname=expname, threads=args.threads)
 
     # Train
+    if args.batch_tokens:
+        next_batch = lambda: data_train.next_batch_by_tokens(args.batch_tokens)
+    else:
+        next_batch = lambda: data_train.next_batch(args.batch_size)
+
     for epoch in range(args.epochs):
         print("Training epoch {}".format(epoch))
-        while not data_train.epoch_finished():
-            sentences, sentence_lens, labels = data_train.next_batch(args.batch_size)
+        for sentences, sentence_lens, labels in batch_prefetcher.BatchPrefetcher(data_train, next_batch, args.prefetch):
             network.train(sentences, sentence_lens, labels)
 
-        network.evaluate(data_dev.sentences, data_dev.sentence_lens, data_dev.labels, "dev")
-        network.evaluate(data_test.sentences, data_test.sentence_lens, data_test.labels, "test")
+        network.evaluate(data_dev, "dev", args.evaluation_batch_size)
+        network.evaluate(data_test, "test", args.evaluation_batch_size)
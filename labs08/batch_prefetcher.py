@@ -0,0 +1,99 @@
+from __future__ import division
+from __future__ import print_function
+
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+class BatchPrefetcher:
+    """Iterator over the batches of one dataset epoch, prepared in a background thread."""
+
+    def __init__(self, dataset, next_batch, prefetch=2, states=False):
+        """Create the prefetcher.
+
+        Arguments:
+        dataset: Dataset providing epoch_finished, e.g., MorphoDataset or NLIDataset.
+        next_batch: Function without arguments returning the next batch of the dataset,
+          e.g., lambda: dataset.next_batch(64, including_charseqs=True).
+        prefetch: Maximum number of prepared batches waiting to be consumed;
+          if zero, the batches are prepared synchronously in the calling thread.
+        states: If true, the iteration state of the dataset (see get_state of the datasets)
+          is taken after preparing every batch, and the state after the last consumed
+          batch is available as the state property. Unlike dataset.get_state, it is not
+          affected by the prefetched batches, so it can be used to checkpoint and later
+          resume the training in the middle of an epoch.
+
+        Every iteration over the prefetcher yields the batches of one epoch, in the same
+        order as the `while not dataset.epoch_finished(): next_batch()` loop. The dataset
+        must not be used by other code during the iteration. If the iteration is stopped
+        early, the worker thread is shut down, but the batches it has already prepared
+        are dropped from the current epoch.
+        """
+        self._dataset = dataset
+        self._next_batch = next_batch
+        self._prefetch = prefetch
+        self._states = states
+        self._state = None
+
+    @property
+    def state(self):
+        """Return the dataset iteration state after the last batch yielded by the iteration,
+        which can be restored by dataset.set_state to continue with the following batch."""
+        if not self._states:
+            raise ValueError("The states of the dataset are taken only when BatchPrefetcher is created with states=True")
+        return self._state
+
+    def _prepare_batch(self):
+        batch = self._next_batch()
+        return batch, self._dataset.get_state() if self._states else None
+
+    def __iter__(self):
+        if self._states:
+            self._state = self._dataset.get_state()
+
+        if not self._prefetch:
+            while not self._dataset.epoch_finished():
+                batch, self._state = self._prepare_batch()
+                yield batch
+            return
+
+        batches = queue.Queue(self._prefetch)
+        stop = threading.Event()
+
+        def put(item):
+            # Wait for a free slot, but give up when the consumer has stopped
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def worker():
+            try:
+                while not self._dataset.epoch_finished():
+                    if not put(("batch", self._prepare_batch())):
+                        return
+                put(("end", None))
+            except Exception as exception:
+                put(("error", exception))
+
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+        try:
+            while True:
+                kind, value = batches.get()
+                if kind == "end":
+                    break
+                if kind == "error":
+                    raise value
+                batch, self._state = value
+                yield batch
+        finally:
+            stop.set()
+            thread.join()
@@ -9,10 +9,12 @@ import sys
 import tensorflow as tf
 import tensorflow.contrib.layers as tf_layers
 
+import batch_prefetcher
 import morpho_dataset
+import word_embeddings
 
 class Network:
-    def __init__(self, rnn_cell, rnn_cell_dim, method, words, logdir, expname, threads=1, seed=42):
+    def __init__(self, rnn_cell, rnn_cell_dim, method, words, logdir, expname, threads=1, seed=42, we=None):
         # Create an empty graph and a session
         graph = tf.Graph()
         graph.seed = seed
@@ -36,14 +38,21 @@ class Network:
             self.forms = tf.placeholder(tf.int32, [None, None])
             self.tags = tf.placeholder(tf.int32, [None, None])
 
+            # If we (WordEmbeddings aligned to the word ids) are given, self.form_wes are the pretrained
+            # embeddings of self.forms; they are gathered for every batch, so that the embedding matrix
+            # is kept in its (possibly quantized) storage instead of being converted to float32 as a whole
+            self._we = we
+            if we:
+                self.form_wes = tf.placeholder(tf.float32, [None, None, we.dimension])
+
             # TODO
-            # loss = ...
+            # self.loss = ...
             # self.training = ...
             # self.predictions = ...
             # self.accuracy = ...
 
             self.dataset_name = tf.placeholder(tf.string, [])
-            self.summary = tf.merge_summary([tf.scalar_summary(self.dataset_name+"/loss", loss),
+            self.summary = tf.merge_summary([tf.scalar_summary(self.dataset_name+"/loss", self.loss),
                                              tf.scalar_summary(self.dataset_name+"/accuracy", self.accuracy)])
 
             # Initialize variables
@@ -53,22 +62,49 @@ class Network:
     def training_step(self):
         return self.session.run(self.global_step)
 
+    def _feed(self, sentence_lens, forms, **feed):
+        feed.update({self.sentence_lens: sentence_lens, self.forms: forms})
+        if self._we:
+            feed[self.form_wes] = self._we.gather(forms)
+        return feed
+
     def train(self, sentence_lens, forms, tags):
         _, summary = self.session.run([self.training, self.summary],
-                                      {self.sentence_lens: sentence_lens, self.forms: forms,
-                                       self.tags: tags, self.dataset_name: "train"})
+                                      self._feed(sentence_lens, forms, **{self.tags: tags, self.dataset_name: "train"}))
         self.summary_writer.add_summary(summary, self.training_step)
 
     def evaluate(self, sentence_lens, forms, tags):
         accuracy, summary = self.session.run([self.accuracy, self.summary],
-                                   {self.sentence_lens: sentence_lens, self.forms: forms,
-                                    self.tags: tags, self.dataset_name: "dev"})
+                                             self._feed(sentence_lens, forms, **{self.tags: tags, self.dataset_name: "dev"}))
         self.summary_writer.add_summary(summary, self.training_step)
         return accuracy
 
     def predict(self, sentence_lens, forms):
-        return self.session.run(self.predictions,
-                                {self.sentence_lens: sentence_lens, self.forms: forms})
+        return self.session.run(self.predictions, self._feed(sentence_lens, forms))
+
+    def evaluate_stream(self, dataset, batch_size):
+        # Evaluate on length-sorted batches, combining the results weighted by the number of words
+        accuracy, loss, words = 0, 0, 0
+        for _, (sentence_lens, word_ids) in dataset.evaluation_batches(batch_size):
+            batch_accuracy, batch_loss = self.session.run([self.accuracy, self.loss],
+                                                          self._feed(sentence_lens, word_ids[dataset.FORMS],
+                                                                     **{self.tags: word_ids[dataset.TAGS]}))
+            accuracy += batch_accuracy * np.sum(sentence_lens)
+            loss += batch_loss * np.sum(sentence_lens)
+            words += np.sum(sentence_lens)
+        accuracy, loss = accuracy / words, loss / words
+        self.summary_writer.add_summary(tf.Summary(value=[tf.Summary.Value(tag="dev/loss", simple_value=loss),
+                                                          tf.Summary.Value(tag="dev/accuracy", simple_value=accuracy)]),
+                                        self.training_step)
+        return accuracy
+
+    def predict_stream(self, dataset, batch_size):
+        # Predict on length-sorted batches, returning the predictions of the sentences in the original order
+        predictions = [None] * len(dataset.sentence_lens)
+        for sentence_ids, (sentence_lens, word_ids) in dataset.evaluation_batches(batch_size):
+            for sentence_id, sentence_predictions in zip(sentence_ids, self.predict(sentence_lens, word_ids[dataset.FORMS])):
+                predictions[sentence_id] = sentence_predictions
+        return predictions
 
 
 if __name__ == "__main__":
@@ -79,56 +115,88 @@ if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument("--batch_size", default=64, type=int, help="Batch size.")
+    parser.add_argument("--batch_tokens", default=0, type=int, help="If nonzero, batch size in padded words instead of sentences.")
+    parser.add_argument("--bucketing", default=0, type=int, help="Batches per length bucket (0 means no bucketing).")
+    parser.add_argument("--cache_dir", default=None, type=str, help="Directory for compiled dataset cache.")
+    parser.add_argument("--parse_processes", default=1, type=int, help="Number of processes parsing the data.")
     parser.add_argument("--data_train", default="en-train.txt", type=str, help="Training data file.")
     parser.add_argument("--data_dev", default="en-dev.txt", type=str, help="Development data file.")
     parser.add_argument("--data_test", default="en-test.txt", type=str, help="Testing data file.")
     parser.add_argument("--epochs", default=10, type=int, help="Number of epochs.")
+    parser.add_argument("--evaluation_batch_size", default=256, type=int, help="Batch size for evaluation and prediction.")
+    parser.add_argument("--prefetch", default=2, type=int, help="Number of batches prepared in background (0 disables prefetching).")
     parser.add_argument("--method", default="learned_we", type=str, help="Which method of word embeddings to use.")
+    parser.add_argument("--we", default=None, type=str, help="Pretrained word embeddings file.")
+    parser.add_argument("--we_storage", default="float32", type=str, help="Pretrained word embeddings storage (float32, float16, int8).")
     parser.add_argument("--logdir", default="logs", type=str, help="Logdir name.")
+    parser.add_argument("--shard", default=0, type=int, help="Index of the training data shard of this worker.")
+    parser.add_argument("--shards", default=1, type=int, help="Number of workers training on disjoint data shards.")
     parser.add_argument("--rnn_cell", default="GRU", type=str, help="RNN cell type.")
     parser.add_argument("--rnn_cell_dim", default=100, type=int, help="RNN cell dimension.")
+    parser.add_argument("--stream_buffer", default=0, type=int, help="If nonzero, stream the training data with this shuffle buffer size.")
     parser.add_argument("--threads", default=1, type=int, help="Maximum number of threads to use.")
     args = parser.parse_args()
 
     # Load the data
     print("Loading the data.", file=sys.stderr)
-    data_train = morpho_dataset.MorphoDataset(args.data_train, add_bow_eow=True)
-    data_dev = morpho_dataset.MorphoDataset(args.data_dev, add_bow_eow=True, train=data_train)
-    data_test = morpho_dataset.MorphoDataset(args.data_test, add_bow_eow=True, train=data_train)
+    if args.stream_buffer:
+        data_train = morpho_dataset.MorphoDatasetStream(args.data_train, add_bow_eow=True, cache_dir=args.cache_dir,
+                                                        buffer_size=args.stream_buffer)
+    else:
+        data_train = morpho_dataset.MorphoDataset(args.data_train, add_bow_eow=True, cache_dir=args.cache_dir,
+                                                  processes=args.parse_processes)
+    data_dev = morpho_dataset.MorphoDataset(args.data_dev, add_bow_eow=True, train=data_train, cache_dir=args.cache_dir,
+                                            processes=args.parse_processes)
+    data_test = morpho_dataset.MorphoDataset(args.data_test, add_bow_eow=True, train=data_train, cache_dir=args.cache_dir,
+                                             processes=args.parse_processes)
+
+    # Load the pretrained word embeddings of the training data words
+    we = None
+    if args.we:
+        print("Loading the word embeddings.", file=sys.stderr)
+        we = word_embeddings.WordEmbeddings(args.we, cache_dir=args.cache_dir, case_fallback=True, storage=args.we_storage,
+                                            vocabulary=data_train.factors[data_train.FORMS]['words'])
+        print("Found embeddings for {} of {} words.".format(np.sum(we.found), len(we.words)), file=sys.stderr)
+
+    if args.shards > 1:
+        data_train.shard(args.shard, args.shards)
 
     # Construct the network
     print("Constructing the network.", file=sys.stderr)
     expname = "tagger-{}{}-m{}-bs{}-epochs{}".format(args.rnn_cell, args.rnn_cell_dim, args.method, args.batch_size, args.epochs)
     network = Network(rnn_cell=args.rnn_cell, rnn_cell_dim=args.rnn_cell_dim, method=args.method,
                       words=len(data_train.factors[data_train.FORMS]['words']),
-                      logdir=args.logdir, expname=expname, threads=args.threads)
+                      logdir=args.logdir, expname=expname, threads=args.threads, we=we)
 
     # Train
+    if args.batch_tokens:
+        next_batch = lambda: data_train.next_batch_by_tokens(args.batch_tokens)
+    else:
+        next_batch = lambda: data_train.next_batch(args.batch_size, bucketing=args.bucketing)
     best_dev_accuracy = 0
     test_predictions = None
 
     for epoch in range(args.epochs):
         print("Training epoch {}".format(epoch + 1), file=sys.stderr)
-        while not data_train.epoch_finished():
-            sentence_lens, word_ids = data_train.next_batch(args.batch_size)
+        for sentence_lens, word_ids in batch_prefetcher.BatchPrefetcher(data_train, next_batch, args.prefetch):
             network.train(sentence_lens, word_ids[data_train.FORMS], word_ids[data_train.TAGS])
             # To use character-level embeddings, pass including_charseqs=True to next_batch
             # and instead of word_ids[data_train.FORMS] use charseq_ids[data_train.FORMS],
             # charseqs[data_train.FORMS] and charseq_lens[data_train.FORMS]
 
-        dev_sentence_lens, dev_word_ids = data_dev.whole_data_as_batch()
-        dev_accuracy = network.evaluate(dev_sentence_lens, dev_word_ids[data_dev.FORMS], dev_word_ids[data_dev.TAGS])
+        dev_accuracy = network.evaluate_stream(data_dev, args.evaluation_batch_size)
         print("Development accuracy after epoch {} is {:.2f}.".format(epoch + 1, 100. * dev_accuracy), file=sys.stderr)
+        if data_train.padding_efficiency is not None:
+            print("Padding efficiency of epoch {} is {:.2f}.".format(epoch + 1, 100. * data_train.padding_efficiency), file=sys.stderr)
 
         if dev_accuracy > best_dev_accuracy:
             best_dev_accuracy = dev_accuracy
-            test_sentence_lens, test_word_ids = data_test.whole_data_as_batch()
-            test_predictions = network.predict(test_sentence_lens, test_word_ids[data_test.FORMS])
+            test_predictions = network.predict_stream(data_test, args.evaluation_batch_size)
 
     # Print test predictions
     test_forms = data_test.factors[data_test.FORMS]['strings'] # We use strings instead of words, because words can be <unk>
     test_tags = data_test.factors[data_test.TAGS]['words']
     for i in range(len(data_test.sentence_lens)):
         for j in range(data_test.sentence_lens[i]):
-            print("{}\t_\t{}".format(test_forms[i][j], test_tags[test_predictions[i, j]]))
+            print("{}\t_\t{}".format(test_forms[i][j], test_tags[test_predictions[i][j]]))
         print()
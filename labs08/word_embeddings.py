@@ -1,28 +1,223 @@
 from __future__ import division
 from __future__ import print_function
 
+import hashlib
+import itertools
+import os
+import pickle
+import shutil
+
 import numpy as np
 
+STORAGES = ["float32", "float16", "int8"]
+
+def quantize(we, storage, block_size=65536):
+    """Convert a float32 embedding matrix to the given storage.
+
+    Returns: (data, scales), where data has the storage dtype and scales are the per-row
+    float32 scales of the int8 storage (None for other storages)
+    """
+    if storage not in STORAGES:
+        raise ValueError("Unknown word embedding storage {}".format(storage))
+    if storage == "float32":
+        return we, None
+
+    # Convert by blocks, so that memory-mapped matrices are never loaded whole
+    data = np.zeros(we.shape, np.dtype(storage))
+    scales = np.zeros(len(we), np.float32) if storage == "int8" else None
+    for start in range(0, len(we), block_size):
+        block = np.asarray(we[start:start + block_size], np.float32)
+        if storage == "int8":
+            block_scales = np.max(np.abs(block), axis=1) / 127
+            block_scales[block_scales == 0] = 1
+            scales[start:start + block_size] = block_scales
+            block = np.round(block / block_scales[:, np.newaxis])
+        data[start:start + block_size] = block
+    return data, scales
+
+def dequantize(data, scales):
+    """Convert the rows returned by quantize back to float32."""
+    data = data.astype(np.float32)
+    if scales is not None:
+        data *= scales[..., np.newaxis]
+    return data
+
+def storage_report(we, samples=1000, seed=42):
+    """Compare the memory and the cosine similarity accuracy of all storages of the given embeddings.
+
+    The cosine similarities of all pairs of samples random words are computed for every storage
+    and compared to the float32 ones.
+
+    Returns: list of (storage, bytes, ratio to float32 bytes, mean and max absolute cosine error)
+    """
+    def cosines(vectors):
+        vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        return np.dot(vectors, vectors.T)
+
+    ids = np.sort(np.random.RandomState(seed).choice(len(we), min(samples, len(we)), replace=False))
+    gold = cosines(np.asarray(we[ids], np.float32))
+    report = []
+    for storage in STORAGES:
+        data, scales = quantize(we, storage)
+        size = data.nbytes + (scales.nbytes if scales is not None else 0)
+        errors = np.abs(cosines(dequantize(data[ids], scales[ids] if scales is not None else None)) - gold)
+        report.append((storage, size, size / (4 * we.size), np.mean(errors), np.max(errors)))
+    return report
+
 class WordEmbeddings:
-    def __init__(self, filename):
-        # Load the word embeddings
-        with open(filename, "rw") as file:
+    def __init__(self, filename, cache_dir=None, chunk_size=10000, vocabulary=None, case_fallback=False, storage="float32"):
+        """Load word embeddings from a text file.
+
+        Arguments:
+        cache_dir: If given, the loaded embeddings are stored in this directory as a .npy matrix
+          with a vocabulary sidecar, and memory-mapped from there when the same file is loaded
+          again. The cache is keyed by the file name, size and modification time.
+        chunk_size: Number of lines converted to the embedding matrix at once.
+        vocabulary: If given, only the embeddings of these words are loaded, e.g., of
+          MorphoDataset.factors[MorphoDataset.FORMS]['words']. Then words is the vocabulary
+          and the rows of we are aligned to its ids, with zero rows for words without
+          an embedding (see found). Only the matching lines of the file are converted;
+          an existing cache is used, but a new one is not created in this mode.
+        case_fallback: If True, words of the vocabulary without an embedding get the first
+          embedding of a word equal to them after lowercasing.
+        storage: How the embeddings are kept in memory, one of STORAGES: "float32",
+          "float16", or "int8" with a float32 scale per row (about 4 times smaller
+          than float32). The embeddings are converted back to float32 by we and gather;
+          see storage_report for the accuracy of the storages.
+        """
+
+        cache_path = self._cache_path(filename, cache_dir) if cache_dir else None
+        if cache_path and os.path.isdir(cache_path):
+            self._load_cache(cache_path)
+            if vocabulary is not None:
+                self._select_vocabulary(vocabulary, case_fallback)
+        elif vocabulary is not None:
+            self._load_file(filename, chunk_size, vocabulary, case_fallback)
+        else:
+            self._load_file(filename, chunk_size)
+            if cache_path:
+                self._save_cache(cache_path)
+        if vocabulary is None:
+            self._found = np.ones(len(self._words), np.bool_)
+        self._storage = storage
+        self._we, self._we_scales = quantize(self._we, storage)
+
+    def _cache_path(self, filename, cache_dir):
+        # Hashing the whole file would be slow for large embeddings, so only its metadata is used
+        stat = os.stat(filename)
+        fingerprint = hashlib.sha1("{},{},{}".format(os.path.abspath(filename), stat.st_size, stat.st_mtime).encode("utf-8"))
+        return os.path.join(cache_dir, "{}-{}".format(os.path.basename(filename), fingerprint.hexdigest()))
+
+    def _vocabulary_matches(self, vocabulary, case_fallback):
+        # For every embedding word, the vocabulary ids it should be stored to, either as an exact
+        # match, or as a lowercased match for the vocabulary words with no exact match
+        self._words = list(vocabulary)
+        self._words_map = dict((word, i) for i, word in enumerate(self._words))
+        self._found = np.zeros(len(self._words), np.bool_)
+        exact = dict((word, [i]) for word, i in self._words_map.items())
+        lowercased = {}
+        if case_fallback:
+            for i, word in enumerate(self._words):
+                lowercased.setdefault(word.lower(), []).append(i)
+        return exact, lowercased
+
+    def _select_vocabulary(self, vocabulary, case_fallback):
+        words, we = self._words, self._we
+        exact, lowercased = self._vocabulary_matches(vocabulary, case_fallback)
+        rows = np.zeros(len(self._words), np.int64)
+        exact_found = np.zeros(len(self._words), np.bool_)
+        for row, word in enumerate(words):
+            for i in exact.get(word, []):
+                if not exact_found[i]:
+                    rows[i], self._found[i], exact_found[i] = row, True, True
+            for i in lowercased.get(word.lower(), []):
+                if not self._found[i]:
+                    rows[i], self._found[i] = row, True
+        self._we = np.where(self._found[:, np.newaxis], we[rows], 0).astype(np.float32)
+
+    def _load_file(self, filename, chunk_size, vocabulary=None, case_fallback=False):
+        with open(filename, "r") as file:
             line = file.readline()
             words, dimension = map(int, line.split(" "))
 
-            self._words = []
-            self._words_map = {}
             self._dimension = dimension
+            if vocabulary is not None:
+                self._load_vocabulary(filename, file, words, chunk_size, vocabulary, case_fallback)
+                return
+
+            self._words = []
             self._we = np.zeros([words, dimension], np.float32)
 
-            for i in range(words):
-                line = file.readline().rstrip("\r\n")
-                if not line:
+            # Convert the vectors of a whole chunk of lines at once, directly to float32
+            for start in range(0, words, chunk_size):
+                lines = list(itertools.islice(file, min(chunk_size, words - start)))
+                if len(lines) < min(chunk_size, words - start):
                     raise ValueError("The word embedding file {} is too short, it should have contained {} words!".format(filename, words))
-                parts = line.split(" ")
-                self._words_map[parts[0]] = len(self._words)
-                self._words.append(parts[0])
-                self._we[i] = map(float, parts[1:])
+                vectors = []
+                for line in lines:
+                    word, vector = line.rstrip("\r\n").split(" ", 1)
+                    self._words.append(word)
+                    vectors.append(vector)
+                chunk = np.fromstring(" ".join(vectors), dtype=np.float32, sep=" ")
+                if chunk.size != len(lines) * dimension:
+                    raise ValueError("The word embedding file {} contains a vector not of dimension {} on lines {}-{}!".format(
+                        filename, dimension, start + 2, start + len(lines) + 1))
+                self._we[start:start + len(lines)] = chunk.reshape([len(lines), dimension])
+
+        self._words_map = dict((word, i) for i, word in enumerate(self._words))
+
+    def _load_vocabulary(self, filename, file, words, chunk_size, vocabulary, case_fallback):
+        exact, lowercased = self._vocabulary_matches(vocabulary, case_fallback)
+        self._we = np.zeros([len(self._words), self._dimension], np.float32)
+        exact_found = np.zeros(len(self._words), np.bool_)
+
+        for start in range(0, words, chunk_size):
+            lines = list(itertools.islice(file, min(chunk_size, words - start)))
+            if len(lines) < min(chunk_size, words - start):
+                raise ValueError("The word embedding file {} is too short, it should have contained {} words!".format(filename, words))
+
+            # Select the lines of the chunk which are needed, converting only their vectors
+            ids, vectors = [], []
+            for line in lines:
+                word, vector = line.rstrip("\r\n").split(" ", 1)
+                for i in exact.get(word, []):
+                    if not exact_found[i]:
+                        exact_found[i] = self._found[i] = True
+                        ids.append(i)
+                        vectors.append(vector)
+                for i in lowercased.get(word.lower(), []):
+                    if not self._found[i]:
+                        self._found[i] = True
+                        ids.append(i)
+                        vectors.append(vector)
+            if ids:
+                chunk = np.fromstring(" ".join(vectors), dtype=np.float32, sep=" ")
+                if chunk.size != len(ids) * self._dimension:
+                    raise ValueError("The word embedding file {} contains a vector not of dimension {} on lines {}-{}!".format(
+                        filename, self._dimension, start + 2, start + len(lines) + 1))
+                self._we[ids] = chunk.reshape([len(ids), self._dimension])
+
+    def _save_cache(self, path):
+        # Write a temporary directory first, so that a partially written cache is never used
+        tmp_path = "{}.tmp{}".format(path, os.getpid())
+        os.makedirs(tmp_path)
+        # Pickle keeps the native str type of the words (bytes in Python 2), which json would not
+        with open(os.path.join(tmp_path, "words.pickle"), "wb") as file:
+            pickle.dump(self._words, file, protocol=2)
+        np.save(os.path.join(tmp_path, "we.npy"), self._we)
+
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # The same cache has been written concurrently by another process
+            shutil.rmtree(tmp_path)
+
+    def _load_cache(self, path):
+        with open(os.path.join(path, "words.pickle"), "rb") as file:
+            self._words = pickle.load(file)
+        self._words_map = dict((word, i) for i, word in enumerate(self._words))
+        self._we = np.load(os.path.join(path, "we.npy"), mmap_mode="r")
+        self._dimension = self._we.shape[1]
 
     @property
     def words(self):
@@ -36,6 +231,152 @@ class WordEmbeddings:
     def dimension(self):
         return self._dimension
 
+    @property
+    def found(self):
+        """Return a boolean mask of the words which have an embedding."""
+        return self._found
+
+    @property
+    def storage(self):
+        return self._storage
+
     @property
     def we(self):
-        return self._we
+        """Return the float32 embedding matrix; for quantized storages, a new dequantized copy."""
+        if self._storage == "float32":
+            return self._we
+        return dequantize(self._we, self._we_scales)
+
+    def gather(self, ids):
+        """Return float32 embeddings of the given ids (of any shape), dequantizing only the needed rows."""
+        ids = np.asarray(ids)
+        return dequantize(self._we[ids], self._we_scales[ids] if self._we_scales is not None else None)
+
+class SimilarityIndex:
+    """Index for finding the words with the most similar embeddings, using cosine similarity."""
+
+    def __init__(self, embeddings, clusters=0, iterations=10, block_size=16384, seed=42):
+        """Create the index.
+
+        Arguments:
+        embeddings: WordEmbeddings to index.
+        clusters: If nonzero, the vectors are clustered by k-means into this number of clusters
+          (around sqrt(words) is a good choice) and queries search only the clusters whose
+          centroids are the most similar to the query, which is approximate but sublinear.
+        iterations: Number of k-means iterations.
+        block_size: Number of vectors multiplied with the queries at once.
+        """
+        self._words = embeddings.words
+        self._words_map = embeddings.words_map
+        self._block_size = block_size
+
+        # Normalize the vectors, so that dot products are cosine similarities
+        self._vectors = self._normalize(np.asarray(embeddings.we, np.float32))
+
+        self._centroids = None
+        if clusters:
+            generator = np.random.RandomState(seed)
+            self._centroids = self._vectors[generator.choice(len(self._vectors), clusters, replace=False)]
+            for _ in range(iterations):
+                assignment = self._assign(self._vectors)
+                sums = np.zeros_like(self._centroids)
+                np.add.at(sums, assignment, self._vectors)
+                # Keep the previous centroids of the clusters which became empty
+                empty = np.bincount(assignment, minlength=clusters) == 0
+                sums[empty] = self._centroids[empty]
+                self._centroids = self._normalize(sums)
+
+            # Store the vectors sorted by clusters, so that every cluster is contiguous
+            assignment = self._assign(self._vectors)
+            self._order = np.argsort(assignment, kind="mergesort")
+            self._cluster_offsets = np.concatenate([[0], np.cumsum(np.bincount(assignment, minlength=clusters))])
+            self._vectors = self._vectors[self._order]
+            self._positions = np.empty_like(self._order)
+            self._positions[self._order] = np.arange(len(self._order))
+
+    @staticmethod
+    def _normalize(vectors):
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+    def _assign(self, vectors):
+        assignment = np.zeros(len(vectors), np.int64)
+        for start in range(0, len(vectors), self._block_size):
+            assignment[start:start + self._block_size] = \
+                np.argmax(np.dot(vectors[start:start + self._block_size], self._centroids.T), axis=1)
+        return assignment
+
+    @staticmethod
+    def _merge_top_k(ids, similarities, block_ids, block_similarities, k):
+        # Keep the k best of the current and the new candidates, unsorted
+        ids = np.concatenate([ids, block_ids], axis=1)
+        similarities = np.concatenate([similarities, block_similarities], axis=1)
+        if similarities.shape[1] > k:
+            rows = np.arange(len(similarities))[:, np.newaxis]
+            best = np.argpartition(-similarities, k - 1, axis=1)[:, :k]
+            ids, similarities = ids[rows, best], similarities[rows, best]
+        return ids, similarities
+
+    def _search(self, queries, start, end, k):
+        # Brute-force search of the given range of (stored) vectors
+        ids = np.zeros([len(queries), 0], np.int64)
+        similarities = np.zeros([len(queries), 0], np.float32)
+        for block_start in range(start, end, self._block_size):
+            block_end = min(block_start + self._block_size, end)
+            block_similarities = np.dot(queries, self._vectors[block_start:block_end].T)
+            block_ids = np.broadcast_to(np.arange(block_start, block_end), block_similarities.shape)
+            ids, similarities = self._merge_top_k(ids, similarities, block_ids, block_similarities, k)
+        return ids, similarities
+
+    def query(self, vectors, k=10, nprobe=1):
+        """Return the k most similar words for every vector.
+
+        Arguments:
+        vectors: Query vectors of shape [queries, dimension].
+        k: Number of returned words.
+        nprobe: When clustered, number of the clusters searched for every query.
+
+        Returns: (ids, similarities), both of shape [queries, k], ordered by decreasing
+        similarity; if fewer than k words are searched, the missing ids are -1
+        """
+        queries = self._normalize(np.atleast_2d(np.asarray(vectors, np.float32)))
+        if self._centroids is None:
+            ids, similarities = self._search(queries, 0, len(self._vectors), k)
+        else:
+            ids = np.full([len(queries), k], -1, np.int64)
+            similarities = np.full([len(queries), k], -np.inf, np.float32)
+            nprobe = min(nprobe, len(self._centroids))
+            probes = np.argpartition(-np.dot(queries, self._centroids.T), nprobe - 1, axis=1)[:, :nprobe]
+
+            # Process the clusters one by one, searching with all the queries which probe them
+            for cluster in np.unique(probes):
+                cluster_queries = np.where(np.any(probes == cluster, axis=1))[0]
+                cluster_ids, cluster_similarities = self._search(
+                    queries[cluster_queries], self._cluster_offsets[cluster], self._cluster_offsets[cluster + 1], k)
+                ids[cluster_queries], similarities[cluster_queries] = self._merge_top_k(
+                    ids[cluster_queries], similarities[cluster_queries], cluster_ids, cluster_similarities, k)
+            ids = np.where(ids >= 0, self._order[np.maximum(ids, 0)], -1)
+
+        # Pad to k results and sort them
+        if ids.shape[1] < k:
+            ids = np.pad(ids, [[0, 0], [0, k - ids.shape[1]]], "constant", constant_values=-1)
+            similarities = np.pad(similarities, [[0, 0], [0, k - similarities.shape[1]]], "constant", constant_values=-np.inf)
+        rows = np.arange(len(similarities))[:, np.newaxis]
+        order = np.argsort(-similarities, axis=1, kind="mergesort")
+        return ids[rows, order], similarities[rows, order]
+
+    def most_similar(self, words, k=10, nprobe=1):
+        """Return the k most similar words for every given word, excluding the word itself.
+
+        Returns: for every word, a list of (word, similarity) pairs
+        """
+        ids, similarities = self.query(self._vectors_of(words), k + 1, nprobe)
+        results = []
+        for word, word_ids, word_similarities in zip(words, ids, similarities):
+            results.append([(self._words[i], float(similarity)) for i, similarity in zip(word_ids, word_similarities)
+                            if i >= 0 and self._words[i] != word][:k])
+        return results
+
+    def _vectors_of(self, words):
+        ids = np.array([self._words_map[word] for word in words], np.int64)
+        return self._vectors[ids if self._centroids is None else self._positions[ids]]
@@ -9,6 +9,7 @@ import sys
 import tensorflow as tf
 import tensorflow.contrib.layers as tf_layers
 
+import batch_prefetcher
 import morpho_dataset
 
 class Network:
@@ -41,13 +42,13 @@ class Network:
             self.lemma_lens = tf.placeholder(tf.int32, [None])
 
             # TODO
-            # loss = ...
+            # self.loss = ...
             # self.training = ...
             # self.predictions = ...
             # self.accuracy = ...
 
             self.dataset_name = tf.placeholder(tf.string, [])
-            self.summary = tf.merge_summary([tf.scalar_summary(self.dataset_name+"/loss", loss),
+            self.summary = tf.merge_summary([tf.scalar_summary(self.dataset_name+"/loss", self.loss),
                                              tf.scalar_summary(self.dataset_name+"/accuracy", self.accuracy)])
 
             # Initialize variables
@@ -79,6 +80,38 @@ class Network:
                                 {self.sentence_lens: sentence_lens,
                                  self.form_ids: form_ids, self.forms: forms, self.form_lens: form_lens})
 
+    def evaluate_stream(self, dataset, batch_size):
+        # Evaluate on length-sorted batches, combining the results weighted by the number of words
+        accuracy, loss, words = 0, 0, 0
+        for _, (sentence_lens, word_ids, charseq_ids, charseqs, charseq_lens) in \
+                dataset.evaluation_batches(batch_size, including_charseqs=True):
+            batch_accuracy, batch_loss = \
+                self.session.run([self.accuracy, self.loss],
+                                 {self.sentence_lens: sentence_lens,
+                                  self.form_ids: charseq_ids[dataset.FORMS], self.forms: charseqs[dataset.FORMS],
+                                  self.form_lens: charseq_lens[dataset.FORMS],
+                                  self.lemma_ids: charseq_ids[dataset.LEMMAS], self.lemmas: charseqs[dataset.LEMMAS],
+                                  self.lemma_lens: charseq_lens[dataset.LEMMAS]})
+            accuracy += batch_accuracy * np.sum(sentence_lens)
+            loss += batch_loss * np.sum(sentence_lens)
+            words += np.sum(sentence_lens)
+        accuracy, loss = accuracy / words, loss / words
+        self.summary_writer.add_summary(tf.Summary(value=[tf.Summary.Value(tag="dev/loss", simple_value=loss),
+                                                          tf.Summary.Value(tag="dev/accuracy", simple_value=accuracy)]),
+                                        self.training_step)
+        return accuracy
+
+    def predict_stream(self, dataset, batch_size):
+        # Predict on length-sorted batches, returning the predictions of the sentences in the original order
+        predictions = [None] * len(dataset.sentence_lens)
+        for sentence_ids, (sentence_lens, word_ids, charseq_ids, charseqs, charseq_lens) in \
+                dataset.evaluation_batches(batch_size, including_charseqs=True):
+            batch_predictions = self.predict(sentence_lens, charseq_ids[dataset.FORMS], charseqs[dataset.FORMS],
+                                             charseq_lens[dataset.FORMS])
+            for sentence_id, sentence_predictions in zip(sentence_ids, batch_predictions):
+                predictions[sentence_id] = sentence_predictions
+        return predictions
+
 
 if __name__ == "__main__":
     # Fix random seed
@@ -88,21 +121,35 @@ if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument("--batch_size", default=64, type=int, help="Batch size.")
+    parser.add_argument("--batch_tokens", default=0, type=int, help="If nonzero, batch size in padded words instead of sentences.")
+    parser.add_argument("--bucketing", default=0, type=int, help="Batches per length bucket (0 means no bucketing).")
+    parser.add_argument("--cache_dir", default=None, type=str, help="Directory for compiled dataset cache.")
+    parser.add_argument("--parse_processes", default=1, type=int, help="Number of processes parsing the data.")
     parser.add_argument("--data_train", default="en-train.txt", type=str, help="Training data file.")
     parser.add_argument("--data_dev", default="en-dev.txt", type=str, help="Development data file.")
     parser.add_argument("--data_test", default="en-test.txt", type=str, help="Testing data file.")
     parser.add_argument("--epochs", default=10, type=int, help="Number of epochs.")
+    parser.add_argument("--evaluation_batch_size", default=256, type=int, help="Batch size for evaluation and prediction.")
+    parser.add_argument("--prefetch", default=2, type=int, help="Number of batches prepared in background (0 disables prefetching).")
     parser.add_argument("--logdir", default="logs", type=str, help="Logdir name.")
     parser.add_argument("--rnn_cell", default="GRU", type=str, help="RNN cell type.")
     parser.add_argument("--rnn_cell_dim", default=100, type=int, help="RNN cell dimension.")
+    parser.add_argument("--stream_buffer", default=0, type=int, help="If nonzero, stream the training data with this shuffle buffer size.")
     parser.add_argument("--threads", default=1, type=int, help="Maximum number of threads to use.")
     args = parser.parse_args()
 
     # Load the data
     print("Loading the data.", file=sys.stderr)
-    data_train = morpho_dataset.MorphoDataset(args.data_train, add_bow_eow=True)
-    data_dev = morpho_dataset.MorphoDataset(args.data_dev, add_bow_eow=True, train=data_train)
-    data_test = morpho_dataset.MorphoDataset(args.data_test, add_bow_eow=True, train=data_train)
+    if args.stream_buffer:
+        data_train = morpho_dataset.MorphoDatasetStream(args.data_train, add_bow_eow=True, cache_dir=args.cache_dir,
+                                                        buffer_size=args.stream_buffer)
+    else:
+        data_train = morpho_dataset.MorphoDataset(args.data_train, add_bow_eow=True, cache_dir=args.cache_dir,
+                                                  processes=args.parse_processes)
+    data_dev = morpho_dataset.MorphoDataset(args.data_dev, add_bow_eow=True, train=data_train, cache_dir=args.cache_dir,
+                                            processes=args.parse_processes)
+    data_test = morpho_dataset.MorphoDataset(args.data_test, add_bow_eow=True, train=data_train, cache_dir=args.cache_dir,
+                                             processes=args.parse_processes)
     bow_char = data_train.alphabet.index("<bow>")
     eow_char = data_train.alphabet.index("<eow>")
 
@@ -114,28 +161,28 @@ if __name__ == "__main__":
                       logdir=args.logdir, expname=expname, threads=args.threads)
 
     # Train
+    if args.batch_tokens:
+        next_batch = lambda: data_train.next_batch_by_tokens(args.batch_tokens, including_charseqs=True)
+    else:
+        next_batch = lambda: data_train.next_batch(args.batch_size, including_charseqs=True, bucketing=args.bucketing)
     best_dev_accuracy = 0
     test_predictions = None
 
     for epoch in range(args.epochs):
         print("Training epoch {}".format(epoch + 1), file=sys.stderr)
-        while not data_train.epoch_finished():
-            sentence_lens, form_ids, charseq_ids, charseqs, charseq_lens = \
-                data_train.next_batch(args.batch_size, including_charseqs=True)
+        for sentence_lens, form_ids, charseq_ids, charseqs, charseq_lens in \
+                batch_prefetcher.BatchPrefetcher(data_train, next_batch, args.prefetch):
             network.train(sentence_lens, charseq_ids[data_train.FORMS], charseqs[data_train.FORMS], charseq_lens[data_train.FORMS],
                           charseq_ids[data_train.LEMMAS], charseqs[data_train.LEMMAS], charseq_lens[data_train.LEMMAS])
 
-        sentence_lens, form_ids, charseq_ids, charseqs, charseq_lens = data_dev.whole_data_as_batch(including_charseqs=True)
-        dev_accuracy = network.evaluate(sentence_lens,
-                                        charseq_ids[data_train.FORMS], charseqs[data_train.FORMS], charseq_lens[data_train.FORMS],
-                                        charseq_ids[data_train.LEMMAS], charseqs[data_train.LEMMAS], charseq_lens[data_train.LEMMAS])
+        dev_accuracy = network.evaluate_stream(data_dev, args.evaluation_batch_size)
         print("Development accuracy after epoch {} is {:.2f}.".format(epoch + 1, 100. * dev_accuracy), file=sys.stderr)
+        if data_train.padding_efficiency is not None:
+            print("Padding efficiency of epoch {} is {:.2f}.".format(epoch + 1, 100. * data_train.padding_efficiency), file=sys.stderr)
 
         if dev_accuracy > best_dev_accuracy:
             best_dev_accuracy = dev_accuracy
-            sentence_lens, form_ids, charseq_ids, charseqs, charseq_lens = data_test.whole_data_as_batch(including_charseqs=True)
-            test_predictions = network.predict(sentence_lens,
-                                               charseq_ids[data_train.FORMS], charseqs[data_train.FORMS], charseq_lens[data_train.FORMS])
+            test_predictions = network.predict_stream(data_test, args.evaluation_batch_size)
 
     # Print test predictions
     test_forms = data_test.factors[data_test.FORMS]['strings'] # We use strings instead of words, because words can be <unk>
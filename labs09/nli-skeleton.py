@@ -9,6 +9,7 @@ import sys
 import tensorflow as tf
 import tensorflow.contrib.layers as tf_layers
 
+import batch_prefetcher
 import nli_dataset
 
 class Network:
@@ -42,13 +43,13 @@ class Network:
             self.languages = tf.placeholder(tf.int32, [None])
 
             # TODO
-            # loss = ...
+            # self.loss = ...
             # self.training = ...
             # self.predictions = ...
             # self.accuracy = ...
 
             self.dataset_name = tf.placeholder(tf.string, [])
-            self.summary = tf.merge_summary([tf.scalar_summary(self.dataset_name+"/loss", loss),
+            self.summary = tf.merge_summary([tf.scalar_summary(self.dataset_name+"/loss", self.loss),
                                              tf.scalar_summary(self.dataset_name+"/accuracy", self.accuracy)])
 
             # Initialize variables
@@ -80,6 +81,33 @@ class Network:
                                 {self.sentence_lens: sentence_lens, self.word_ids: word_ids,
                                  self.charseq_ids: charseq_ids, self.charseqs: charseqs, self.charseq_lens: charseq_lens})
 
+    def evaluate_stream(self, dataset, batch_size, dataset_name):
+        # Evaluate on length-sorted batches, combining the losses weighted by the number of sentences.
+        # The accuracy is measured on essays, combining the predictions of their sentences (windows).
+        loss, predictions = 0, np.zeros(len(dataset.essay_ids), np.int32)
+        for sentence_ids, (sentence_lens, word_ids, charseq_ids, charseqs, charseq_lens, tags, levels, prompts, languages) in \
+                dataset.evaluation_batches(batch_size):
+            predictions[sentence_ids], batch_loss = \
+                self.session.run([self.predictions, self.loss],
+                                 {self.sentence_lens: sentence_lens, self.word_ids: word_ids,
+                                  self.charseq_ids: charseq_ids, self.charseqs: charseqs, self.charseq_lens: charseq_lens,
+                                  self.languages: languages})
+            loss += batch_loss * len(sentence_lens)
+        loss = loss / len(predictions)
+        accuracy = np.mean(dataset.essay_predictions(predictions) == dataset.essay_languages)
+        self.summary_writer.add_summary(tf.Summary(value=[tf.Summary.Value(tag=dataset_name+"/loss", simple_value=loss),
+                                                          tf.Summary.Value(tag=dataset_name+"/accuracy", simple_value=accuracy)]),
+                                        self.training_step)
+        return accuracy
+
+    def predict_stream(self, dataset, batch_size):
+        # Predict on length-sorted batches, returning the predictions of the sentences in the original order
+        predictions = np.zeros(len(dataset.essay_ids), np.int32)
+        for sentence_ids, (sentence_lens, word_ids, charseq_ids, charseqs, charseq_lens, tags, levels, prompts, languages) in \
+                dataset.evaluation_batches(batch_size):
+            predictions[sentence_ids] = self.predict(sentence_lens, word_ids, charseq_ids, charseqs, charseq_lens)
+        return predictions
+
 
 if __name__ == "__main__":
     # Fix random seed
@@ -89,11 +117,19 @@ if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument("--batch_size", default=16, type=int, help="Batch size.")
+    parser.add_argument("--batch_tokens", default=0, type=int, help="If nonzero, batch size in padded words instead of sentences.")
+    parser.add_argument("--bucketing", default=0, type=int, help="Batches per length bucket (0 means no bucketing).")
     parser.add_argument("--data_train", default="nli-train.txt", type=str, help="Training data file.")
     parser.add_argument("--data_dev", default="nli-dev.txt", type=str, help="Development data file.")
     parser.add_argument("--data_test", default="nli-test.txt", type=str, help="Testing data file.")
     parser.add_argument("--epochs", default=10, type=int, help="Number of epochs.")
+    parser.add_argument("--evaluation_batch_size", default=64, type=int, help="Batch size for evaluation and prediction.")
+    parser.add_argument("--prefetch", default=2, type=int, help="Number of batches prepared in background (0 disables prefetching).")
+    parser.add_argument("--max_words", default=0, type=int, help="If nonzero, truncate essays to this number of words.")
+    parser.add_argument("--window", default=0, type=int, help="If nonzero, split essays into windows of this number of words.")
     parser.add_argument("--logdir", default="logs", type=str, help="Logdir name.")
+    parser.add_argument("--shard", default=0, type=int, help="Index of the training data shard of this worker.")
+    parser.add_argument("--shards", default=1, type=int, help="Number of workers training on disjoint data shards.")
     parser.add_argument("--rnn_cell", default="GRU", type=str, help="RNN cell type.")
     parser.add_argument("--rnn_cell_dim", default=100, type=int, help="RNN cell dimension.")
     parser.add_argument("--threads", default=1, type=int, help="Maximum number of threads to use.")
@@ -101,9 +137,13 @@ if __name__ == "__main__":
 
     # Load the data
     print("Loading the data.", file=sys.stderr)
-    data_train = nli_dataset.NLIDataset(args.data_train)
-    data_dev = nli_dataset.NLIDataset(args.data_dev, train=data_train)
-    data_test = nli_dataset.NLIDataset(args.data_test, train=data_train, no_languages=True)
+    data_train = nli_dataset.NLIDataset(args.data_train, max_words=args.max_words, window=args.window)
+    data_dev = nli_dataset.NLIDataset(args.data_dev, train=data_train, max_words=args.max_words, window=args.window)
+    data_test = nli_dataset.NLIDataset(args.data_test, train=data_train, no_languages=True,
+                                       max_words=args.max_words, window=args.window)
+
+    if args.shards > 1:
+        data_train.shard(args.shard, args.shards)
 
     # Construct the network
     print("Constructing the network.", file=sys.stderr)
@@ -113,26 +153,27 @@ if __name__ == "__main__":
                       logdir=args.logdir, expname=expname, threads=args.threads)
 
     # Train
+    if args.batch_tokens:
+        next_batch = lambda: data_train.next_batch_by_tokens(args.batch_tokens)
+    else:
+        next_batch = lambda: data_train.next_batch(args.batch_size, bucketing=args.bucketing)
     best_dev_accuracy = 0
     test_predictions = None
 
     for epoch in range(args.epochs):
         print("Training epoch {}".format(epoch + 1), file=sys.stderr)
-        while not data_train.epoch_finished():
-            sentence_lens, word_ids, charseq_ids, charseqs, charseq_lens, tags, levels, prompts, languages = \
-                data_train.next_batch(args.batch_size)
+        for sentence_lens, word_ids, charseq_ids, charseqs, charseq_lens, tags, levels, prompts, languages in \
+                batch_prefetcher.BatchPrefetcher(data_train, next_batch, args.prefetch):
             network.train(sentence_lens, word_ids, charseq_ids, charseqs, charseq_lens, languages)
 
-        sentence_lens, word_ids, charseq_ids, charseqs, charseq_lens, tags, levels, prompts, languages = \
-            data_dev.whole_data_as_batch()
-        dev_accuracy = network.evaluate(sentence_lens, word_ids, charseq_ids, charseqs, charseq_lens, languages, "dev")
+        dev_accuracy = network.evaluate_stream(data_dev, args.evaluation_batch_size, "dev")
         print("Development accuracy after epoch {} is {:.2f}.".format(epoch + 1, 100. * dev_accuracy), file=sys.stderr)
+        if data_train.padding_efficiency is not None:
+            print("Padding efficiency of epoch {} is {:.2f}.".format(epoch + 1, 100. * data_train.padding_efficiency), file=sys.stderr)
 
         if dev_accuracy > best_dev_accuracy:
             best_dev_accuracy = dev_accuracy
-            sentence_lens, word_ids, charseq_ids, charseqs, charseq_lens, tags, levels, prompts, languages = \
-                data_test.whole_data_as_batch()
-            test_predictions = network.predict(sentence_lens, word_ids, charseq_ids, charseqs, charseq_lens)
+            test_predictions = data_test.essay_predictions(network.predict_stream(data_test, args.evaluation_batch_size))
 
     # Print test predictions
     for prediction in test_predictions:
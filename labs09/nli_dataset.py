@@ -3,15 +3,22 @@ from __future__ import print_function
 
 import numpy as np
 
+import char_encoding
+
 class NLIDataset:
     """Class capable of loading NLI dataset."""
 
-    def __init__(self, filename, add_bow_eow=False, train=None, no_languages=False):
+    def __init__(self, filename, add_bow_eow=False, train=None, no_languages=False, max_words=0, window=0):
         """Load dataset from a given file.
 
         Arguments:
         add_bow_eow: Whether to add BOW/EOW characters to the word characters.
         train: If given, the vocabularies from the training data will be reused.
+        max_words: If nonzero, every essay is truncated to its first max_words words.
+        window: If nonzero, every (possibly truncated) essay is split into consecutive
+          windows of window words (the last one may be shorter), which are then used
+          as the dataset sentences, each with the labels of its essay. Predictions
+          of the windows can be combined using essay_predictions.
         """
 
         # Create vocabulary_maps
@@ -27,13 +34,14 @@ class NLIDataset:
         self._word_ids = []
         self._charseq_ids = []
         self._charseqs_map = {'<pad>': 0}
-        self._charseqs = []
         self._tags = []
         self._languages = []
         self._levels = []
         self._prompts = []
+        new_charseqs = []
 
         # Load the sentences
+        sentence_lens = []
         with open(filename, "r") as file:
             for line in file:
                 line = line.rstrip("\r\n")
@@ -49,28 +57,15 @@ class NLIDataset:
                 self._levels.append(self._vocabulary_maps['levels'][level])
                 self._prompts.append(self._vocabulary_maps['prompts'][prompt])
 
-                self._word_ids.append([])
-                self._tags.append([])
-                self._charseq_ids.append([])
+                sentence_lens.append(0)
                 for word_tag in words.split("\t"):
                     word, tag = word_tag.split(" ") if len(word_tag) else ("\n", "\n")
 
-                    # Characters
+                    # Characters, converted to ids only after loading all the sentences
                     if word not in self._charseqs_map:
-                        self._charseqs_map[word] = len(self._charseqs)
-                        self._charseqs.append([])
-                        if add_bow_eow:
-                            self._charseqs[-1].append(self._vocabulary_maps['chars']['<bow>'])
-                        for c in word:
-                            if c not in self._vocabulary_maps['chars']:
-                                if not train:
-                                    self._vocabulary_maps['chars'][c] = len(self._vocabulary_maps['chars'])
-                                else:
-                                    c = '<unk>'
-                            self._charseqs[-1].append(self._vocabulary_maps['chars'][c])
-                        if add_bow_eow:
-                            self._charseqs[-1].append(self._vocabulary_maps['chars']['<eow>'])
-                    self._charseq_ids[-1].append(self._charseqs_map[word])
+                        self._charseqs_map[word] = len(new_charseqs)
+                        new_charseqs.append(word)
+                    self._charseq_ids.append(self._charseqs_map[word])
 
                     # Words
                     if word not in self._vocabulary_maps['words']:
@@ -78,7 +73,7 @@ class NLIDataset:
                             self._vocabulary_maps['words'][word] = len(self._vocabulary_maps['words'])
                         else:
                             word = '<unk>'
-                    self._word_ids[-1].append(self._vocabulary_maps['words'][word])
+                    self._word_ids.append(self._vocabulary_maps['words'][word])
 
                     # Tags
                     if tag not in self._vocabulary_maps['tags']:
@@ -86,13 +81,43 @@ class NLIDataset:
                             self._vocabulary_maps['tags'][tag] = len(self._vocabulary_maps['tags'])
                         else:
                             tag = '<unk>'
-                    self._tags[-1].append(self._vocabulary_maps['tags'][tag])
+                    self._tags.append(self._vocabulary_maps['tags'][tag])
+                    sentence_lens[-1] += 1
+
+        # Convert the characters of all charseqs at once, storing them in a flat form
+        chars, self._charseq_lens = char_encoding.encode_chars(new_charseqs, self._vocabulary_maps['chars'], grow=not train)
+        if add_bow_eow:
+            # Every charseq grows by two, the BOW and EOW surrounding its characters
+            charseq_starts = np.concatenate([[0], np.cumsum(self._charseq_lens[:-1] + 2, dtype=np.int64)]).astype(np.int64)
+            self._charseq_lens = self._charseq_lens + 2
+            bow_eow_chars = np.zeros(len(chars) + 2 * len(new_charseqs), np.int32)
+            bow_eow_chars[charseq_starts] = self._vocabulary_maps['chars']['<bow>']
+            bow_eow_chars[charseq_starts + self._charseq_lens - 1] = self._vocabulary_maps['chars']['<eow>']
+            bow_eow_chars[np.arange(len(chars)) + 2 * np.repeat(np.arange(len(new_charseqs)), self._charseq_lens - 2) + 1] = chars
+            chars = bow_eow_chars
+        self._charseq_chars = chars.astype(np.int32)
+        self._charseq_offsets = np.concatenate([[0], np.cumsum(self._charseq_lens[:-1], dtype=np.int64)]).astype(np.int64)
+
+        # Store the words of all sentences in flat arrays, indexed by sentence offsets
+        self._sentence_lens = np.array(sentence_lens, np.int32)
+        self._sentence_offsets = np.concatenate([[0], np.cumsum(self._sentence_lens[:-1], dtype=np.int64)]).astype(np.int64)
+        self._word_ids = np.array(self._word_ids, np.int32)
+        self._charseq_ids = np.array(self._charseq_ids, np.int32)
+        self._tags = np.array(self._tags, np.int16)
+        self._languages = np.array(self._languages, np.int16)
+        self._levels = np.array(self._levels, np.int16)
+        self._prompts = np.array(self._prompts, np.int16)
 
-        # Compute sentence lengths
-        sentences = len(self._word_ids)
-        self._sentence_lens = np.zeros([sentences], np.int32)
-        for i in range(sentences):
-            self._sentence_lens[i] = len(self._word_ids[i])
+        # Truncate the essays and split them into windows, which then act as sentences
+        self._essay_ids = np.arange(len(self._sentence_lens))
+        if max_words:
+            self._sentence_lens = np.minimum(self._sentence_lens, max_words).astype(np.int32)
+        if window:
+            windows = (self._sentence_lens + window - 1) // window
+            self._essay_ids = np.repeat(self._essay_ids, windows)
+            window_starts = window * (np.arange(len(self._essay_ids)) - np.repeat(np.cumsum(windows) - windows, windows))
+            self._sentence_offsets = self._sentence_offsets[self._essay_ids] + window_starts
+            self._sentence_lens = np.minimum(self._sentence_lens[self._essay_ids] - window_starts, window).astype(np.int32)
 
         # Create vocabularies
         if train:
@@ -104,7 +129,29 @@ class NLIDataset:
                 for word, id in words.items():
                     self._vocabularies[feature][id] = word
 
+        self._whole_data_batch = None
+        self._evaluation_batches = {}
+
+        self._shard_index, self._shard_count = 0, 1
         self._permutation = np.random.permutation(len(self._sentence_lens))
+        self._epoch_batches, self._epoch_words, self._epoch_padded_words = 0, 0, 0
+        self._padding_efficiency = None
+
+    @property
+    def padding_efficiency(self):
+        """Return the ratio of the real words to all batch positions including padding,
+        measured over the batches of the last finished epoch."""
+        return self._padding_efficiency
+
+    @property
+    def essay_ids(self):
+        """Return the index of the essay of every sentence (window)."""
+        return self._essay_ids
+
+    @property
+    def essay_languages(self):
+        """Return the language ids of all essays (-1 if loaded with no_languages)."""
+        return self._languages
 
     def vocabulary(self, feature):
         """Return vocabulary for required feature.
@@ -119,10 +166,15 @@ class NLIDataset:
         """
         return self._vocabularies[feature]
 
-    def next_batch(self, batch_size):
+    def next_batch(self, batch_size, bucketing=0):
         """Return the next batch.
 
         Arguments:
+        bucketing: If nonzero, sentences of similar lengths are batched together to reduce
+          padding. The sentences are sorted by length and split into buckets of `bucketing`
+          batches; the sentences are shuffled inside the buckets and the resulting batches
+          are shuffled. Takes effect when passed to the first next_batch of an epoch.
+
         Returns: (sentence_lens, word_ids, charseq_ids, charseqs, charseq_lens, tags, levels, prompts, languages)
         sequence_lens: batch of sentence_lens
         word_ids: batch of word_ids
@@ -136,23 +188,144 @@ class NLIDataset:
         languages: batch of languages
         """
 
+        if bucketing and not self._epoch_batches:
+            self._permutation = self._bucketed_permutation(self._permutation, batch_size, bucketing)
         batch_size = min(batch_size, len(self._permutation))
         batch_perm = self._permutation[:batch_size]
         self._permutation = self._permutation[batch_size:]
+        self._epoch_batches += 1
+        self._epoch_words += np.sum(self._sentence_lens[batch_perm])
+        self._epoch_padded_words += batch_size * np.max(self._sentence_lens[batch_perm])
         return self._next_batch(batch_perm)
 
+    def next_batch_by_tokens(self, max_tokens):
+        """Return the next batch containing at most max_tokens words including padding.
+
+        Sentences are taken from the current permutation as long as the padded batch size
+        batch_size * max_sentence_len does not exceed max_tokens; at least one sentence
+        is always returned. Returns the same results as next_batch.
+        """
+
+        # Every sentence has at least one word, so at most max_tokens sentences can fit
+        sentence_lens = self._sentence_lens[self._permutation[:max_tokens]]
+        padded_sizes = np.maximum.accumulate(sentence_lens) * np.arange(1, len(sentence_lens) + 1)
+        return self.next_batch(max(1, np.searchsorted(padded_sizes, max_tokens, side="right")))
+
     def epoch_finished(self):
         if len(self._permutation) == 0:
-            self._permutation = np.random.permutation(len(self._sentence_lens))
+            self._permutation = self._shard_permutation(np.random.permutation(len(self._sentence_lens)))
+            self._padding_efficiency = self._epoch_words / self._epoch_padded_words if self._epoch_padded_words else None
+            self._epoch_batches, self._epoch_words, self._epoch_padded_words = 0, 0, 0
             return True
         return False
 
+    def essay_predictions(self, predictions):
+        """Combine the predictions of all sentences (windows) into essay predictions.
+
+        Arguments:
+        predictions: predictions for all sentences in the order of whole_data_as_batch,
+          either predicted ids of shape [sentences], which are combined by majority vote,
+          or scores (e.g., probabilities) of shape [sentences, classes], which are summed.
+
+        Returns: predicted ids of all essays, ties resolved in favour of the smaller id
+        """
+        predictions = np.asarray(predictions)
+        if predictions.ndim == 1:
+            predictions = np.eye(np.max(predictions) + 1)[predictions]
+        essay_scores = np.zeros([self._essay_ids[-1] + 1, predictions.shape[1]])
+        np.add.at(essay_scores, self._essay_ids, predictions)
+        return np.argmax(essay_scores, axis=1).astype(np.int32)
+
+    def shard(self, index, count):
+        """Iterate only over the given shard of every epoch, for data-parallel training.
+
+        Every epoch permutation is generated from the global NumPy random generator as
+        usual and split into count shards of equal size, the shard index being used;
+        the last len % count sentences of the permutation are skipped in the epoch.
+        When all workers seed the generator identically and use the same options,
+        their shards of every epoch are disjoint and have the same number of batches.
+        Must be called at the beginning of an epoch, before the first batch.
+        """
+        if not 0 <= index < count:
+            raise ValueError("Shard index {} is not in range [0, {})".format(index, count))
+        if self._epoch_batches or len(self._permutation) != len(self._sentence_lens):
+            raise ValueError("The dataset can be sharded only once, at the beginning of an epoch")
+        self._shard_index, self._shard_count = index, count
+        self._permutation = self._shard_permutation(self._permutation)
+
+    def _shard_permutation(self, permutation):
+        if self._shard_count == 1:
+            return permutation
+        return permutation[:len(permutation) - len(permutation) % self._shard_count][self._shard_index::self._shard_count]
+
+    def get_state(self):
+        """Return the iteration state, which can be pickled and later restored by set_state.
+
+        The state contains the rest of the current epoch permutation, the statistics
+        of the current epoch and the state of the global NumPy random generator, which
+        generates the permutations of the following epochs; after set_state, the dataset
+        returns exactly the same batches as it would have without interruption. When
+        batches are prefetched, the batches waiting in the prefetcher are already removed
+        from the permutation, so use the state of BatchPrefetcher created with states=True.
+        """
+        return {'permutation': np.array(self._permutation), 'epoch_batches': self._epoch_batches,
+                'epoch_words': self._epoch_words, 'epoch_padded_words': self._epoch_padded_words,
+                'padding_efficiency': self._padding_efficiency, 'random_state': np.random.get_state()}
+
+    def set_state(self, state):
+        """Restore the iteration state returned by get_state."""
+        self._permutation = np.array(state['permutation'])
+        self._epoch_batches, self._epoch_words, self._epoch_padded_words = \
+            state['epoch_batches'], state['epoch_words'], state['epoch_padded_words']
+        self._padding_efficiency = state['padding_efficiency']
+        np.random.set_state(state['random_state'])
+
     def whole_data_as_batch(self):
         """Return the whole dataset in the same result as next_batch.
 
-        Returns the same results as next_batch.
+        Returns the same results as next_batch. The batch is computed only once and
+        returned read-only; the data never change after loading, any code replacing
+        them must reset _whole_data_batch.
         """
-        return self._next_batch(np.arange(len(self._sentence_lens)))
+        if self._whole_data_batch is None:
+            self._whole_data_batch = self._next_batch(np.arange(len(self._sentence_lens)))
+            for array in self._whole_data_batch:
+                array.setflags(write=False)
+        return self._whole_data_batch
+
+    def evaluation_batches(self, batch_size):
+        """Return the whole dataset split into batches of sentences sorted by length.
+
+        Returns: list of (sentence_ids, batch) pairs, where batch has the same form as
+        the results of next_batch and sentence_ids are the indices of its sentences
+        in the dataset, which allow to restore the original order of predictions.
+        The batches are computed only once for every batch_size and are read-only,
+        the same as in whole_data_as_batch.
+        """
+        if batch_size not in self._evaluation_batches:
+            order = np.argsort(self._sentence_lens, kind="mergesort")
+            self._evaluation_batches[batch_size] = []
+            for start in range(0, len(order), batch_size):
+                sentence_ids, batch = order[start:start + batch_size], self._next_batch(order[start:start + batch_size])
+                for array in (sentence_ids,) + batch:
+                    array.setflags(write=False)
+                self._evaluation_batches[batch_size].append((sentence_ids, batch))
+        return self._evaluation_batches[batch_size]
+
+    def _bucketed_permutation(self, permutation, batch_size, bucketing):
+        # Sort by length; the stable sort keeps the random order of sentences of the same length
+        permutation = permutation[np.argsort(self._sentence_lens[permutation], kind="mergesort")]
+
+        # Shuffle the sentences inside the buckets, each consisting of `bucketing` batches
+        bucket_size = batch_size * bucketing
+        for start in range(0, len(permutation), bucket_size):
+            permutation[start:start + bucket_size] = np.random.permutation(permutation[start:start + bucket_size])
+
+        # Shuffle the full batches, keeping the possibly incomplete last batch at the end
+        batches = len(permutation) // batch_size
+        batch_order = np.random.permutation(batches)
+        return np.concatenate([permutation[:batches * batch_size].reshape([batches, batch_size])[batch_order].ravel(),
+                               permutation[batches * batch_size:]])
 
     def _next_batch(self, batch_perm):
         batch_size = len(batch_perm)
@@ -161,38 +334,34 @@ class NLIDataset:
         batch_sentence_lens = self._sentence_lens[batch_perm]
         max_sentence_len = np.max(batch_sentence_lens)
 
+        # Mask of the non-padding batch positions and the corresponding indices to the flat word arrays
+        batch_mask = np.arange(max_sentence_len) < batch_sentence_lens[:, np.newaxis]
+        batch_words = (self._sentence_offsets[batch_perm, np.newaxis] + np.arange(max_sentence_len))[batch_mask]
+
         # Word-level data
         batch_word_ids = np.zeros([batch_size, max_sentence_len], np.int32)
-        for i in range(batch_size):
-            batch_word_ids[i, 0:batch_sentence_lens[i]] = self._word_ids[batch_perm[i]]
+        batch_word_ids[batch_mask] = self._word_ids[batch_words]
         batch_tags = np.zeros([batch_size, max_sentence_len], np.int32)
-        for i in range(batch_size):
-            batch_tags[i, 0:batch_sentence_lens[i]] = self._tags[batch_perm[i]]
-        batch_levels = np.zeros([batch_size], np.int32)
-        for i in range(batch_size):
-            batch_levels[i] = self._levels[batch_perm[i]]
-        batch_prompts = np.zeros([batch_size], np.int32)
-        for i in range(batch_size):
-            batch_prompts[i] = self._prompts[batch_perm[i]]
-        batch_languages = np.zeros([batch_size], np.int32)
-        for i in range(batch_size):
-            batch_languages[i] = self._languages[batch_perm[i]]
-
-        # Character-level data
+        batch_tags[batch_mask] = self._tags[batch_words]
+        batch_essays = self._essay_ids[batch_perm]
+        batch_levels = self._levels[batch_essays].astype(np.int32)
+        batch_prompts = self._prompts[batch_essays].astype(np.int32)
+        batch_languages = self._languages[batch_essays].astype(np.int32)
+
+        # Character-level data, numbering the unique charseqs in the order of their first occurrence in the batch
+        charseqs, first_occurrences, charseq_ids = np.unique(self._charseq_ids[batch_words], return_index=True, return_inverse=True)
+        order = np.argsort(first_occurrences)
+        charseqs = charseqs[order]
+        charseqs_map = np.empty_like(order)
+        charseqs_map[order] = np.arange(len(order))
         batch_charseq_ids = np.zeros([batch_size, max_sentence_len], np.int32)
-        charseqs_map, charseqs, charseq_lens = {}, [], []
-        for i in range(batch_size):
-            for j, charseq_id in enumerate(self._charseq_ids[batch_perm[i]]):
-                if charseq_id not in charseqs_map:
-                    charseqs_map[charseq_id] = len(charseqs)
-                    charseqs.append(self._charseqs[charseq_id])
-                batch_charseq_ids[i, j] = charseqs_map[charseq_id]
-
-        batch_charseq_lens = np.array([len(charseq) for charseq in charseqs], np.int32)
-        batch_charseqs = np.zeros([len(charseqs), np.max(batch_charseq_lens)], np.int32)
-        for i in range(len(charseqs)):
-            batch_charseqs[i, 0:len(charseqs[i])] = charseqs[i]
+        batch_charseq_ids[batch_mask] = charseqs_map[charseq_ids]
+
+        batch_charseq_lens = self._charseq_lens[charseqs]
+        charseqs_mask = np.arange(np.max(batch_charseq_lens)) < batch_charseq_lens[:, np.newaxis]
+        batch_charseqs = np.zeros(charseqs_mask.shape, np.int32)
+        batch_charseqs[charseqs_mask] = self._charseq_chars[
+            (self._charseq_offsets[charseqs, np.newaxis] + np.arange(charseqs_mask.shape[1]))[charseqs_mask]]
 
         return batch_sentence_lens, batch_word_ids, batch_charseq_ids, batch_charseqs, batch_charseq_lens, \
             batch_tags, batch_levels, batch_prompts, batch_languages
-
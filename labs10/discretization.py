@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+
+def discretization(env_name):
+    """Return the discretization (bins, separators, place_values) of the continuous observations
+    of the given environment, where separators is a [dimensions, bins - 1] array of the separators
+    of all dimensions, and place_values are the place values of the dimension buckets in the state
+    index (the first dimension being the most significant)."""
+    if env_name.startswith("CartPole"):
+        bins = 6
+        separators = [
+            np.linspace(-2.4, 2.4, num=bins + 1)[1:-1], # cart position
+            np.linspace(-3, 3, num=bins + 1)[1:-1],     # pole angle
+            np.linspace(-0.5, 0.5, num=bins + 1)[1:-1], # cart velocity
+            np.linspace(-2, 2, num=bins + 1)[1:-1],     # pole angle velocity
+        ]
+    elif env_name.startswith("MountainCar"):
+        bins = 12
+        separators = [
+            np.linspace(-1.2, 0.6, num=bins + 1)[1:-1],  # car position
+            np.linspace(-0.07, 0.07, num=bins + 1)[1:-1],# car velocity
+        ]
+    else:
+        raise ValueError("Environment {} is not descrete and has no discretionazitaion".format(env_name))
+
+    return bins, np.array(separators), bins ** np.arange(len(separators) - 1, -1, -1)
+
+def discretize(observation, separators, place_values):
+    """Discretize an observation, or a batch of observations of shape [batch, dimensions]."""
+    # The bucket of a value is the number of separators not greater than it (as in np.digitize),
+    # and the buckets of all dimensions are combined as digits of a number in base bins
+    buckets = np.sum(np.asarray(observation)[..., np.newaxis] >= separators, axis=-1)
+    return np.dot(buckets, place_values)
@@ -6,6 +6,54 @@ import gym
 import gym.envs.classic_control.rendering as gym_rendering
 import numpy as np
 
+def _polygon_masks(polygons, height, width):
+    """Return [batch, height, width] masks of the pixels inside the given convex polygons,
+    given as a [batch, vertices, 2] array of their (y, x) vertices.
+
+    As in the scanline fill of https://github.com/luispedro/mahotas/blob/master/mahotas/polygon.py,
+    the intersections of every row y with the edges covering it (the edges with y in
+    (min_y, max_y]) bound the pixels of the row from the left and from the right. The
+    intersections are computed for all rows, edges and polygons at once, and the masks
+    are then obtained by comparing the bounds with the columns of the pixel grid.
+    """
+    rows = np.arange(height)[np.newaxis, :, np.newaxis]
+    columns = np.arange(width)
+
+    # Edges from every vertex to the previous one, as [batch, 1, vertices] arrays
+    ys, xs = polygons[:, np.newaxis, :, 0], polygons[:, np.newaxis, :, 1]
+    previous = np.arange(-1, polygons.shape[1] - 1)
+    previous_ys, previous_xs = ys[:, :, previous], xs[:, :, previous]
+    covering = (np.minimum(ys, previous_ys) < rows) & (rows <= np.maximum(ys, previous_ys))
+    intersections = xs + (rows - ys) / np.where(covering, previous_ys - ys, 1) * (previous_xs - xs)
+
+    left = np.floor(np.min(np.where(covering, intersections, np.inf), axis=2))
+    right = np.max(np.where(covering, intersections, -np.inf), axis=2)
+    return (columns >= left[:, :, np.newaxis]) & (columns <= right[:, :, np.newaxis])
+
+def draw(env_name, observations):
+    """Draw the frames of the given batch of observations as a [batch, 80, 80] float32 array."""
+    observations = np.asarray(observations, dtype=np.float64)
+    if env_name.startswith("CartPole"):
+        position, angle = observations[:, 0], observations[:, 2]
+        cart = 40 + position / 3 * 40
+        pole_x = np.trunc(40 + (position + np.sin(angle) * 4.2) / 3 * 40)
+        pole_y = np.trunc(70 - np.cos(angle) * 5.2 / 3 * 40)
+
+        # The cart and the pole polygons, as [2, batch, 4, (y, x)] array
+        polygons = np.empty([2, len(observations), 4, 2])
+        polygons[0, :, :, 0] = [70, 80, 80, 70]
+        polygons[0, :, :, 1] = cart[:, np.newaxis] + [-10, -10, 10, 10]
+        polygons[1, :, :, 0] = 70
+        polygons[1, :, 0, 0], polygons[1, :, 3, 0] = pole_y, pole_y
+        polygons[1, :, :, 1] = np.stack([pole_x, cart, cart, pole_x], axis=1) + [-2, -2, 2, 2]
+
+        cart_masks, pole_masks = _polygon_masks(polygons.reshape([-1, 4, 2]), 80, 80).reshape([2, -1, 80, 80])
+        frames = np.where(cart_masks, np.float32(0.5), np.float32(0))
+        frames[pole_masks] = 1
+        return frames
+    else:
+        raise ValueError("Environment {} not supported in EnvironmentPixels".format(env_name))
+
 class EnvironmentPixels:
     def __init__(self, env_name):
         self._env_name = env_name
@@ -13,25 +61,26 @@ class EnvironmentPixels:
         self._iw = gym_rendering.SimpleImageViewer()
         if self._env_name.startswith("CartPole"):
             self._images = 3
-            self._image = np.zeros([80, 80, self._images], dtype=np.float32)
+            # The last self._images frames are kept in a ring buffer, self._index being the oldest one
+            self._frames = np.zeros([80, 80, self._images], dtype=np.float32)
+            self._index = 0
         else:
             raise ValueError("Environment {} not supported in EnvironmentPixels".format(env_name))
 
+    @property
+    def _image(self):
+        # The frames in chronological order, gathered into a new array, so that the returned
+        # observations are not overwritten by the following steps
+        return self._frames[:, :, (self._index + np.arange(self._images)) % self._images]
+
     def _draw(self, observation):
-        if self._env_name.startswith("CartPole"):
-            for i in range(self._images - 1):
-                self._image[:, :, i] = self._image[:, :, i + 1]
-            cart = 40 + observation[0] / 3 * 40
-            pole_x = int(40 + (observation[0] + np.sin(observation[2]) * 4.2) / 3 * 40)
-            pole_y = int(70 - np.cos(observation[2]) * 5.2 / 3 * 40)
-            self._image[:, :, self._images - 1] = 0
-            self._fill_polygon([(70, cart-10), (80, cart-10), (80, cart+10), (70, cart+10)], self._image[:, :, self._images - 1], 0.5)
-            self._fill_polygon([(pole_y, pole_x-2), (70, cart-2), (70, cart+2), (pole_y, pole_x+2)], self._image[:, :, self._images - 1], 1)
-            return self._image
+        self._frames[:, :, self._index] = draw(self._env_name, [observation])[0]
+        self._index = (self._index + 1) % self._images
+        return self._image
 
     @property
     def observations(self):
-        return list(self._image.shape)
+        return [80, 80, self._images]
 
     @property
     def actions(self):
@@ -51,43 +100,3 @@ class EnvironmentPixels:
     def render(self):
         if self._env_name.startswith("CartPole"):
             self._iw.imshow((self._image[:, :, :3]*255).astype(np.uint8))
-
-    # Taken from https://github.com/luispedro/mahotas/blob/master/mahotas/polygon.py
-    def _fill_polygon(self, polygon, canvas, color=1):
-        '''
-        fill_polygon([(y0,x0), (y1,x1),...], canvas, color=1)
-        Draw a filled polygon in canvas
-        Parameters
-        ----------
-        polygon : list of pairs
-            a list of (y,x) points
-        canvas : ndarray
-            where to draw, will be modified in place
-        color : integer, optional
-            which colour to use (default: 1)
-        '''
-        # algorithm adapted from: http://www.alienryderflex.com/polygon_fill/
-        if not len(polygon):
-            return
-        min_y = min(y for y,x in polygon)
-        max_y = max(y for y,x in polygon)
-        polygon = [(float(y),float(x)) for y,x in polygon]
-        if max_y < canvas.shape[0]:
-            max_y += 1
-        for y in range(min_y, max_y):
-            nodes = []
-            j = -1
-            for i,p in enumerate(polygon):
-                pj = polygon[j]
-                if p[0] < y and pj[0] >= y or pj[0] < y and p[0] >= y:
-                    dy = pj[0] - p[0]
-                    if dy:
-                        nodes.append( (p[1] + (y-p[0])/(pj[0]-p[0])*(pj[1]-p[1])) )
-                    elif p[0] == y:
-                        nodes.append(p[1])
-                j = i
-            nodes.sort()
-            for n,nn in zip(nodes[::2],nodes[1::2]):
-                nn += 1
-                canvas[y, int(n):int(nn)] = color
-
@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+from __future__ import division
+from __future__ import print_function
+
+import multiprocessing
+
+import numpy as np
+
+def _step_with_reset(env, action):
+    # Perform a step, resetting the environment when its episode ends
+    observation, reward, done, info = env.step(action)
+    if done:
+        info = dict(info, terminal_observation=np.array(observation))
+        observation = env.reset()
+    return observation, reward, done, info
+
+def _worker(environment, env_name, indices, connection, buffers):
+    # Step the environments with the given indices, storing the results in the shared buffers
+    observations, rewards, dones = [_shared_array(*buffer) for buffer in buffers]
+    envs = [environment(env_name) for _ in indices]
+    while True:
+        command, data = connection.recv()
+        if command == "reset":
+            for i, env in zip(indices, envs):
+                observations[i] = env.reset()
+            connection.send(None)
+        elif command == "step":
+            infos = []
+            for i, env, action in zip(indices, envs, data):
+                observations[i], rewards[i], dones[i], info = _step_with_reset(env, action)
+                infos.append(info)
+            connection.send(infos)
+        elif command == "render":
+            envs[0].render()
+            connection.send(None)
+        elif command == "close":
+            connection.close()
+            return
+
+def _shared_buffer(shape, dtype):
+    # Allocate shared memory for an array, to be passed to the worker processes as their argument;
+    # a NumPy view of the memory would be pickled by value by the spawn and forkserver start methods
+    dtype = np.dtype(dtype)
+    return multiprocessing.RawArray("B", int(np.prod(shape)) * dtype.itemsize), shape, dtype
+
+def _shared_array(buffer, shape, dtype):
+    # Return a NumPy array using the given shared memory
+    return np.frombuffer(buffer, dtype).reshape(shape)
+
+class VectorEnvironment:
+    """Several instances of an environment, stepped together on stacked arrays.
+
+    The environments are automatically reset when their episode ends, so that the
+    policy can always be evaluated on a batch of all current observations, e.g.:
+
+        env = VectorEnvironment(environment_continuous.EnvironmentContinuous, "CartPole-v1", 8)
+        observations = env.reset()
+        while ...:
+            probabilities = pg.predict(observations)
+            actions = [np.random.choice(len(p), p=p) for p in probabilities]
+            observations, rewards, dones, infos = env.step(actions)
+    """
+
+    def __init__(self, environment, env_name, count):
+        """Create count instances of the given environment class (e.g., EnvironmentContinuous,
+        EnvironmentDiscrete or EnvironmentPixels) for the given env_name."""
+        self._envs = [environment(env_name) for _ in range(count)]
+        self._returns = np.zeros(count, np.float64)
+        self._lengths = np.zeros(count, np.int64)
+
+    @property
+    def count(self):
+        return len(self._envs)
+
+    @property
+    def environments(self):
+        return self._envs
+
+    @property
+    def observations(self):
+        return self._envs[0].observations
+
+    @property
+    def states(self):
+        return self._envs[0].states
+
+    @property
+    def actions(self):
+        return self._envs[0].actions
+
+    def reset(self):
+        """Reset all environments and return their stacked observations."""
+        self._returns[:], self._lengths[:] = 0, 0
+        return np.array([env.reset() for env in self._envs])
+
+    def step(self, actions):
+        """Perform one action in every environment.
+
+        Returns: (observations, rewards, dones, infos)
+        observations: stacked observations; for environments whose episode has just
+          ended, the first observation of their new episode
+        rewards: float32 rewards
+        dones: bool flags of the episodes which have just ended
+        infos: list of info dictionaries; for the ended episodes, they also contain
+          terminal_observation, episode_return and episode_length
+        """
+        observations, rewards, dones, infos = self._step(actions)
+
+        # Track the returns and lengths of the episodes
+        self._returns += rewards
+        self._lengths += 1
+        for i in np.where(dones)[0]:
+            infos[i] = dict(infos[i], episode_return=self._returns[i], episode_length=self._lengths[i])
+            self._returns[i], self._lengths[i] = 0, 0
+
+        return observations, rewards, dones, infos
+
+    def _step(self, actions):
+        observations, rewards, dones, infos = [], np.zeros(self.count, np.float32), np.zeros(self.count, np.bool_), []
+        for i, (env, action) in enumerate(zip(self._envs, actions)):
+            observation, rewards[i], dones[i], info = _step_with_reset(env, action)
+            observations.append(observation)
+            infos.append(info)
+        return np.array(observations), rewards, dones, infos
+
+    def render(self):
+        """Render the first environment."""
+        self._envs[0].render()
+
+
+class SubprocessVectorEnvironment(VectorEnvironment):
+    """VectorEnvironment stepping the environments in parallel in worker processes.
+
+    The workers write the observations, rewards and done flags directly to
+    shared-memory arrays, which are returned by reset and step without copying;
+    they are therefore overwritten by the following reset or step, and must be
+    copied if they are needed longer. Only the actions and the (usually empty)
+    infos are sent through pipes. Call close to stop the workers.
+    """
+
+    def __init__(self, environment, env_name, count, processes):
+        """Create count instances of the given environment class for the given env_name,
+        distributed evenly to the given number of worker processes."""
+        # An environment in this process provides the properties and the observation shape
+        self._envs = [environment(env_name)]
+        observation = np.asarray(self._envs[0].reset())
+        self._count = count
+        self._returns = np.zeros(count, np.float64)
+        self._lengths = np.zeros(count, np.int64)
+
+        buffers = [_shared_buffer([count] + list(observation.shape), observation.dtype),
+                   _shared_buffer([count], np.float32), _shared_buffer([count], np.bool_)]
+        self._observations, self._rewards, self._dones = [_shared_array(*buffer) for buffer in buffers]
+
+        self._connections, self._workers = [], []
+        for indices in np.array_split(np.arange(count), min(processes, count)):
+            connection, worker_connection = multiprocessing.Pipe()
+            worker = multiprocessing.Process(target=_worker, args=(environment, env_name, indices, worker_connection, buffers))
+            worker.daemon = True
+            worker.start()
+            worker_connection.close()
+            self._connections.append((connection, indices))
+            self._workers.append(worker)
+
+    @property
+    def count(self):
+        return self._count
+
+    @property
+    def environments(self):
+        raise ValueError("The environments of SubprocessVectorEnvironment live in the worker processes")
+
+    def reset(self):
+        self._returns[:], self._lengths[:] = 0, 0
+        for connection, _ in self._connections:
+            connection.send(("reset", None))
+        for connection, _ in self._connections:
+            connection.recv()
+        return self._observations
+
+    def _step(self, actions):
+        actions = np.asarray(actions)
+        for connection, indices in self._connections:
+            connection.send(("step", actions[indices]))
+        infos = []
+        for connection, _ in self._connections:
+            infos.extend(connection.recv())
+        return self._observations, self._rewards, self._dones, infos
+
+    def render(self):
+        """Render the first environment."""
+        connection, _ = self._connections[0]
+        connection.send(("render", None))
+        connection.recv()
+
+    def close(self):
+        """Stop the worker processes."""
+        for connection, _ in self._connections:
+            connection.send(("close", None))
+            connection.close()
+        for worker in self._workers:
+            worker.join()
+        self._connections, self._workers = [], []